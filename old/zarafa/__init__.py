@@ -32,6 +32,20 @@ Main classes:
 
 :class:`Attachment`
 
+:class:`Stream`
+
+:class:`Q`
+
+:class:`RetryPolicy`
+
+:class:`FileStateStore`
+
+:class:`SQLiteStateStore`
+
+:class:`SyncScheduler`
+
+:class:`Watcher`
+
 :class:`Address`
 
 :class:`Outofoffice`
@@ -48,6 +62,8 @@ Main classes:
 # Python 2.5 doesn't have with
 from __future__ import with_statement
 
+import codecs
+import collections
 import contextlib
 import cPickle as pickle
 import csv
@@ -57,16 +73,19 @@ import lockfile
 import daemon.pidlockfile
 import datetime
 import grp
+import itertools
 try:
     import libcommon # XXX distribute with python-mapi? or rewrite functionality here?
 except ImportError:
     pass
 import logging.handlers
 from multiprocessing import Process, Queue
+from multiprocessing.pool import ThreadPool
 from Queue import Empty
 import optparse
 import os.path
 import pwd
+import random
 import socket
 import sys
 import StringIO
@@ -130,6 +149,13 @@ GUID_NAMESPACE = {
 }
 NAMESPACE_GUID = dict((b,a) for (a,b) in GUID_NAMESPACE.items()) 
 
+# named properties used by Item/Recurrence, resolved together on first lookup
+NAMED_PROPS_PREFETCH = [
+    ('common', 34070), ('common', 34071),
+    ('appointment', 33315), ('appointment', 33302), ('appointment', 33321),
+    ('appointment', 33330), ('appointment', 33333), ('appointment', 33334),
+]
+
 # XXX copied from common/ECDefs.h
 def OBJECTCLASS(__type, __class):
     return (__type << 16) | (__class & 0xFFFF)
@@ -137,6 +163,7 @@ def OBJECTCLASS(__type, __class):
 OBJECTTYPE_MAILUSER = 1
 ACTIVE_USER = OBJECTCLASS(OBJECTTYPE_MAILUSER, 1)
 NONACTIVE_USER = OBJECTCLASS(OBJECTTYPE_MAILUSER, 2)
+NONACTIVE_CONTACT = OBJECTCLASS(OBJECTTYPE_MAILUSER, 5)
 
 # XXX copied from zarafa-msr/main.py
 MUIDECSAB = DEFINE_GUID(0x50a921ac, 0xd340, 0x48ee, 0xb3, 0x19, 0xfb, 0xa7, 0x53, 0x30, 0x44, 0x25)
@@ -167,32 +194,73 @@ ARO_SUBTYPE = 0x0080
 ARO_APPTCOLOR = 0x0100
 ARO_EXCEPTIONAL_BODY = 0x0200
 
-# location of entryids in PR_IPM_OL2007_ENTRYIDS
-RSF_PID_RSS_SUBSCRIPTION = 0x8001
-RSF_PID_SUGGESTED_CONTACTS = 0x8008
+# block size for reading/writing property streams
+STREAM_BLOCK_SIZE = 0x10000 # 64KB
 
-def _stream(mapiobj, proptag):
-    stream = mapiobj.OpenProperty(proptag, IID_IStream, 0, 0)
+# table rows contain at most this many chars/bytes for string/binary columns
+TABLE_CAP_STRING = 255
 
-    if proptag == PR_RTF_COMPRESSED:
-        stream = WrapCompressedRTFStream(stream, 0)
+# number of opened stores kept around by server-wide sync
+STORE_CACHE_SIZE = 512
 
-    block_size = 0x10000 # 1MB
+# importers with update_batch/delete_batch get changes in batches of at most this many changes/seconds
+SYNC_BATCH_SIZE = 500
+SYNC_BATCH_TIME = 1.0
 
-    data = []
-    while True:
-        temp = stream.Read(block_size)
-        data.append(temp)
+# RetryPolicy keeps at most this many sourcekeys of skipped changes
+SYNC_MAX_QUARANTINE = 10000
 
-        if len(temp) < block_size:
-            break
+# sync with a state store saves its state every this many changes/seconds
+SYNC_CHECKPOINT_CHANGES = 1000
+SYNC_CHECKPOINT_TIME = 60.0
+
+# SyncScheduler: changes per folder per turn, seconds between turns for busy/idle folders
+SYNC_TURN_CHANGES = 100
+SYNC_HOT_INTERVAL = 1.0
+SYNC_IDLE_INTERVAL = 60.0
 
-    data = ''.join(data)
+# Watcher: seconds between sync passes when no notifications arrive
+SYNC_POLL_INTERVAL = 300.0
+WATCH_EVENTS = fnevObjectCreated | fnevObjectDeleted | fnevObjectModified | fnevObjectMoved | fnevObjectCopied
 
-    if PROP_TYPE(proptag) == PT_UNICODE:
-        data = data.decode('utf-32le') # under windows them be utf-16le?
+# special folder entryids (and store type), see Store.clear_cache
+STORE_SPECIAL_PROPTAGS = [
+    PR_MDB_PROVIDER, PR_IPM_SUBTREE_ENTRYID, PR_IPM_PUBLIC_FOLDERS_ENTRYID,
+    PR_IPM_OUTBOX_ENTRYID, PR_IPM_WASTEBASKET_ENTRYID, PR_IPM_SENTMAIL_ENTRYID,
+]
+ROOT_SPECIAL_PROPTAGS = [
+    PR_ENTRYID, PR_ADDITIONAL_REN_ENTRYIDS, PR_IPM_APPOINTMENT_ENTRYID, PR_IPM_CONTACT_ENTRYID,
+    PR_IPM_DRAFTS_ENTRYID, PR_IPM_JOURNAL_ENTRYID, PR_IPM_NOTE_ENTRYID, PR_IPM_TASK_ENTRYID,
+]
+
+# hierarchy table columns, see Folder.folders
+HIERARCHY_COLUMNS = [
+    PR_ENTRYID, PR_PARENT_ENTRYID, PR_DEPTH, PR_DISPLAY_NAME_W, PR_CONTAINER_CLASS, PR_EC_HIERARCHYID,
+    PR_CONTENT_COUNT, PR_CONTENT_UNREAD, PR_ASSOCIATED_CONTENT_COUNT, PR_FOLDER_CHILD_COUNT, PR_MESSAGE_SIZE_EXTENDED,
+]
+
+# mailbox table columns used to build (unopened) stores
+MAILBOX_COLUMNS = [
+    PR_ENTRYID, PR_DISPLAY_NAME_W, PR_STORE_RECORD_KEY, PR_EC_STORETYPE, PR_MAILBOX_OWNER_ENTRYID,
+    PR_MESSAGE_SIZE_EXTENDED, PR_LAST_LOGON_TIME, PR_LAST_LOGOFF_TIME,
+]
+
+# location of entryids in PR_IPM_OL2007_ENTRYIDS
+RSF_PID_RSS_SUBSCRIPTION = 0x8001
+RSF_PID_SUGGESTED_CONTACTS = 0x8008
+
+def _stream(mapiobj, proptag):
+    return Stream(mapiobj, proptag).read()
 
-    return data
+def _nameid(namespace, name):
+    if isinstance(name, (int, long)):
+        return MAPINAMEID(NAMESPACE_GUID[namespace], MNID_ID, name)
+    else:
+        return MAPINAMEID(NAMESPACE_GUID[namespace], MNID_STRING, unicode(name))
+
+def _name_ids(mapiobj, keys):
+    proptags = mapiobj.GetIDsFromNames([_nameid(namespace, name) for (namespace, name) in keys], 0)
+    return dict((key, proptag) for (key, proptag) in zip(keys, proptags) if PROP_TYPE(proptag) != PT_ERROR)
 
 def _prop(self, mapiobj, proptag):
     if isinstance(proptag, (int, long)):
@@ -201,27 +269,70 @@ def _prop(self, mapiobj, proptag):
         except MAPIErrorNotEnoughMemory:
             data = _stream(mapiobj, proptag)
             sprop = SPropValue(proptag, data)
-        return Property(mapiobj, sprop)
+        return _owned(Property(mapiobj, sprop), self)
     else:
         namespace, name = proptag.split(':') # XXX syntax
         if name.isdigit(): # XXX
             name = int(name)
-        for prop in self.props(namespace=namespace): # XXX sloow, streaming
-            if prop.name == name:
-                return prop
-        raise MAPIErrorNotFound
+        if namespace not in NAMESPACE_GUID:
+            raise MAPIErrorNotFound
+        store = None # only objects inside a store share its name cache (not users etc.)
+        if isinstance(self, Store):
+            store = self
+        elif isinstance(self, (Folder, Item)):
+            store = getattr(self, 'store', None)
+        if isinstance(store, Store):
+            proptag = store._name_id(namespace, name)
+        else:
+            proptag = _name_ids(mapiobj, [(namespace, name)]).get((namespace, name))
+        if proptag is None:
+            raise MAPIErrorNotFound
+        proptag = CHANGE_PROP_TYPE(proptag, PT_UNSPECIFIED) # server returns actual type
+        sprop = mapiobj.GetProps([proptag], MAPI_UNICODE)[0] # not HrGetOneProp, which returns PT_STRING8
+        if PROP_TYPE(sprop.ulPropTag) == PT_ERROR:
+            if sprop.Value == MAPI_E_NOT_FOUND:
+                raise MAPIErrorNotFound
+            elif sprop.Value != MAPI_E_NOT_ENOUGH_MEMORY: # else let Property determine type and stream
+                raise MAPIError(sprop.Value)
+        return _owned(Property(mapiobj, sprop, _nameid(namespace, name)), self)
+
+def _owned(prop, obj): # Property.value setter joins obj.batch()
+    if hasattr(obj, '_batch_props'):
+        prop._owner = obj
+    return prop
+
+def _nameids(mapiobj, proptags):
+    # resolve all named properties in a single call
+    named = [proptag for proptag in proptags if (proptag >> 16) >= 0x8000]
+    if not named:
+        return {}
+    try:
+        lpnames = mapiobj.GetNamesFromIDs(named, None, 0)
+    except MAPIErrorNoSupport: # XXX user.props()?
+        return dict((proptag, None) for proptag in named)
+    return dict(zip(named, lpnames))
+
+def _column_prop(self, proptag): # property from table row, or None if we need to look further
+    sprop = self._columns.get(proptag)
+    if sprop is not None:
+        if PROP_TYPE(sprop.ulPropTag) == PT_ERROR:
+            if sprop.Value == MAPI_E_NOT_FOUND:
+                raise MAPIErrorNotFound
+        elif not (PROP_TYPE(sprop.ulPropTag) in (PT_UNICODE, PT_STRING8, PT_BINARY) and len(sprop.Value) >= TABLE_CAP_STRING): # possibly truncated
+            return _owned(Property(_DelayedMapiobj(self), sprop), self)
 
 def _props(mapiobj, namespace=None):
     # XXX show and stream large properties
     proptags = mapiobj.GetPropList(MAPI_UNICODE)
     sprops = mapiobj.GetProps(proptags, MAPI_UNICODE)
-    props = [Property(mapiobj, sprop) for sprop in sprops]
+    nameids = _nameids(mapiobj, proptags)
+    props = [Property(mapiobj, sprop, nameids.get(proptag, False)) for proptag, sprop in zip(proptags, sprops)]
     for p in sorted(props):
         if not namespace or p.namespace == namespace:
             yield p
 
-def _state(mapiobj, associated=False):
-    exporter = mapiobj.OpenProperty(PR_CONTENTS_SYNCHRONIZER, IID_IExchangeExportChanges, 0, 0)
+def _state(mapiobj, associated=False, hierarchy=False):
+    exporter = mapiobj.OpenProperty(PR_HIERARCHY_SYNCHRONIZER if hierarchy else PR_CONTENTS_SYNCHRONIZER, IID_IExchangeExportChanges, 0, 0)
     if associated:
         exporter.Config(None, SYNC_NORMAL | SYNC_ASSOCIATED | SYNC_CATCHUP, None, None, None, None, 0)
     else:
@@ -234,9 +345,14 @@ def _state(mapiobj, associated=False):
     stream.Seek(0, MAPI.STREAM_SEEK_SET)
     return bin2hex(stream.Read(0xFFFFF))
 
-def _sync(server, syncobj, importer, state, log, max_changes, associated=False, window=None):
-    importer = TrackingContentsImporter(server, importer, log)
-    exporter = syncobj.OpenProperty(PR_CONTENTS_SYNCHRONIZER, IID_IExchangeExportChanges, 0, 0)
+def _sync(server, syncobj, importer, state, log, max_changes, associated=False, window=None, open_items=True, batch_size=SYNC_BATCH_SIZE, batch_time=SYNC_BATCH_TIME, checkpoint=None, retry_policy=None, hierarchy=False, store=None):
+    retry_policy = retry_policy or RetryPolicy()
+    if hierarchy:
+        importer = TrackingHierarchyImporter(server, importer, log, retry_policy.quarantine, store)
+        exporter = syncobj.OpenProperty(PR_HIERARCHY_SYNCHRONIZER, IID_IExchangeExportChanges, 0, 0)
+    else:
+        importer = TrackingContentsImporter(server, importer, log, open_items, retry_policy.quarantine, store)
+        exporter = syncobj.OpenProperty(PR_CONTENTS_SYNCHRONIZER, IID_IExchangeExportChanges, 0, 0)
     stream = IStream()
     stream.Write(state.decode('hex'))
     stream.Seek(0, MAPI.STREAM_SEEK_SET)
@@ -251,6 +367,8 @@ def _sync(server, syncobj, importer, state, log, max_changes, associated=False,
     else:
         exporter.Config(stream, SYNC_NORMAL | SYNC_UNICODE, importer, restriction, None, None, 0)
     step = retry = changes = 0
+    last_flush = last_checkpoint = time.time()
+    checkpoint_changes = 0
     while True:
         try:
             try:
@@ -262,20 +380,79 @@ def _sync(server, syncobj, importer, state, log, max_changes, associated=False,
             if (steps == step) or (max_changes and changes >= max_changes):
                 break
         except MAPIError, e:
+            transient = retry_policy.transient(e)
+            max_retries = retry_policy.max_retries if transient else retry_policy.max_change_retries
             if log:
-                log.warn("Received a MAPI error or timeout (error=0x%x, retry=%d/5)" % (e.hr, retry))
-            time.sleep(5)
-            if retry < 5:
+                log.warn("Received a MAPI error or timeout (error=0x%x, retry=%d/%d)" % (e.hr, retry, max_retries))
+            if retry < max_retries:
+                time.sleep(retry_policy.delay(retry))
                 retry += 1
+            elif transient: # server unreachable, not the fault of this change
+                raise
             else:
                 if log:
                     log.error("Too many retries, skipping change")
-                importer.skip = True # in case of a timeout or other issue, try to skip the change after trying several times
+                importer.skip = True # try to skip the change after trying several times
                 retry = 0
+        if importer.pending and (len(importer.pending) >= batch_size or time.time() - last_flush >= batch_time):
+            importer.flush()
+            last_flush = time.time()
+        if checkpoint and (changes - checkpoint_changes >= SYNC_CHECKPOINT_CHANGES or time.time() - last_checkpoint >= SYNC_CHECKPOINT_TIME):
+            checkpoint(_sync_state(exporter, importer, stream))
+            last_flush = last_checkpoint = time.time()
+            checkpoint_changes = changes
+    state = _sync_state(exporter, importer, stream)
+    if checkpoint:
+        checkpoint(state)
+    return state
+
+def _sync_state(exporter, importer, stream):
+    importer.flush() # state only moves forward once all changes were delivered
     exporter.UpdateState(stream)
     stream.Seek(0, MAPI.STREAM_SEEK_SET)
-    state = bin2hex(stream.Read(0xFFFFF))
-    return state
+    return bin2hex(stream.Read(0xFFFFF))
+
+def _set_props(obj, sprops): # SetProps and SaveChanges, or collect them until the end of obj.batch()
+    if obj._columns: # table row value is outdated now
+        for sprop in sprops:
+            obj._columns.pop(sprop.ulPropTag, None)
+    if obj._batch_props is not None:
+        for sprop in sprops:
+            obj._batch_props[sprop.ulPropTag] = sprop
+        obj._batch_save = True
+    else:
+        obj.mapiobj.SetProps(sprops)
+        obj.mapiobj.SaveChanges(KEEP_OPEN_READWRITE)
+
+def _flush_batch(obj, mapiobj): # apply collected changes before mapiobj is used, so reads see them
+    if obj._batch_props:
+        sprops, obj._batch_props = obj._batch_props.values(), {}
+        mapiobj.SetProps(sprops)
+
+@contextlib.contextmanager
+def _batch(obj, save=False):
+    if obj._batch_props is not None: # nested
+        yield obj
+        return
+    obj._batch_props = {}
+    obj._batch_save = save
+    try:
+        yield obj
+        mapiobj = obj.mapiobj # sends collected props in one SetProps
+        if obj._batch_save:
+            mapiobj.SaveChanges(KEEP_OPEN_READWRITE)
+    except:
+        if obj._batch_save and not save and obj._mapiobj is not None: # changes may already be on the open object
+            _discard_changes(obj)
+        raise
+    finally:
+        obj._batch_props = None
+        obj._batch_save = False
+
+def _discard_changes(obj): # reopen on next use, dropping unsaved changes
+    if obj._entryid is None:
+        obj._entryid = HrGetOneProp(obj._mapiobj, PR_ENTRYID).Value
+    obj._mapiobj = None
 
 def _openentry_raw(mapistore, entryid, flags): # avoid underwater action for archived items
     try:
@@ -377,14 +554,79 @@ class SPropDelayedValue(SPropValue):
         return self._Value
 
 
+class Stream(object):
+    """
+    File-like wrapper around a MAPI property stream
+
+    Data is read in blocks of *block_size* bytes; unicode properties are decoded incrementally.
+    Iterating over a stream returns its data block by block.
+
+    """
+
+    def __init__(self, mapiobj, proptag, block_size=STREAM_BLOCK_SIZE):
+        self.proptag = proptag
+        self.block_size = block_size
+        self._stream = mapiobj.OpenProperty(proptag, IID_IStream, 0, 0)
+        if proptag == PR_RTF_COMPRESSED:
+            self._stream = WrapCompressedRTFStream(self._stream, 0)
+        self._decoder = None
+        if PROP_TYPE(proptag) == PT_UNICODE:
+            self._decoder = codecs.getincrementaldecoder('utf-32le')() # under windows them be utf-16le?
+        self._eof = False
+
+    def _read(self, size):
+        if self._eof:
+            data = ''
+        else:
+            data = self._stream.Read(size)
+            self._eof = (len(data) < size)
+        if self._decoder:
+            data = self._decoder.decode(data, final=self._eof)
+        return data
+
+    def read(self, size=-1):
+        """ Read at most *size* bytes (characters for unicode properties), or everything if *size* is negative """
+
+        if size < 0:
+            return (u'' if self._decoder else '').join(self)
+        if self._decoder:
+            size *= 4
+        return self._read(size)
+
+    def __iter__(self):
+        while not self._eof:
+            data = self._read(self.block_size)
+            if data:
+                yield data
+
+    def close(self):
+        self._stream = None
+        self._eof = True
+
+    def __unicode__(self):
+        return u'Stream(%s)' % REV_TAG.get(self.proptag, hex(self.proptag))
+
+    def __repr__(self):
+        return unicode(self).encode(sys.stdout.encoding or 'utf8')
+
+
+class _DelayedMapiobj(object): # XXX pass around items/folders instead of mapiobjs?
+    def __init__(self, obj):
+        self._obj = obj
+
+    def __getattr__(self, x):
+        return getattr(self._obj.mapiobj, x)
+
+
 class Property(object):
     """ 
 Wrapper around MAPI properties 
 
 """
 
-    def __init__(self, parent_mapiobj, mapiobj): # XXX rethink attributes, names.. add guidname..?
+    def __init__(self, parent_mapiobj, mapiobj, nameid=False): # XXX rethink attributes, names.. add guidname..?
         self._parent_mapiobj = parent_mapiobj
+        self._owner = None # Item/Folder, for batched changes
 
         if PROP_TYPE(mapiobj.ulPropTag) == PT_ERROR and mapiobj.Value == MAPI_E_NOT_ENOUGH_MEMORY:
             for proptype in (PT_BINARY, PT_UNICODE): # XXX slow, incomplete?
@@ -402,26 +644,57 @@ Wrapper around MAPI properties
         self.mapiobj = mapiobj
         self._value = None
 
-        self.idname = REV_TAG.get(self.proptag) # XXX slow, often unused: make into properties?
         self.type_ = PROP_TYPE(self.proptag)
-        self.typename = REV_TYPE.get(self.type_)
         self.named = (self.id_ >= 0x8000)
-        self.kind = None
-        self.kindname = None
-        self.guid = None
-        self.name = None
-        self.namespace = None
+        self._nameid = nameid # False: not resolved yet, None: not available
 
-        if self.named:
-            try:
-                lpname = self._parent_mapiobj.GetNamesFromIDs([self.proptag], None, 0)[0]
-                self.guid = bin2hex(lpname.guid)
-                self.namespace = GUID_NAMESPACE.get(lpname.guid)
-                self.name = lpname.id
-                self.kind = lpname.kind
-                self.kindname = 'MNID_STRING' if lpname.kind == MNID_STRING else 'MNID_ID'
-            except MAPIErrorNoSupport: # XXX user.props()?
-                pass
+    @property
+    def idname(self):
+        return REV_TAG.get(self.proptag)
+
+    @property
+    def typename(self):
+        return REV_TYPE.get(self.type_)
+
+    def _get_nameid(self):
+        if self._nameid is False:
+            self._nameid = None
+            if self.named:
+                try:
+                    self._nameid = self._parent_mapiobj.GetNamesFromIDs([self.proptag], None, 0)[0]
+                except MAPIErrorNoSupport: # XXX user.props()?
+                    pass
+        return self._nameid
+
+    @property
+    def guid(self):
+        nameid = self._get_nameid()
+        if nameid:
+            return bin2hex(nameid.guid)
+
+    @property
+    def namespace(self):
+        nameid = self._get_nameid()
+        if nameid:
+            return GUID_NAMESPACE.get(nameid.guid)
+
+    @property
+    def name(self):
+        nameid = self._get_nameid()
+        if nameid:
+            return nameid.id
+
+    @property
+    def kind(self):
+        nameid = self._get_nameid()
+        if nameid:
+            return nameid.kind
+
+    @property
+    def kindname(self):
+        nameid = self._get_nameid()
+        if nameid:
+            return 'MNID_STRING' if nameid.kind == MNID_STRING else 'MNID_ID'
 
     def get_value(self):
         if self._value is None:
@@ -441,8 +714,11 @@ Wrapper around MAPI properties
         if self.type_ == PT_SYSTIME:
             # Timezones are handled.
             value = MAPI.Time.unixtime(time.mktime(value.timetuple()))
-        self._parent_mapiobj.SetProps([SPropValue(self.proptag, value)])
-        self._parent_mapiobj.SaveChanges(KEEP_OPEN_READWRITE)
+        if self._owner is not None: # batched changes, table row cache
+            _set_props(self._owner, [SPropValue(self.proptag, value)])
+        else:
+            self._parent_mapiobj.SetProps([SPropValue(self.proptag, value)])
+            self._parent_mapiobj.SaveChanges(KEEP_OPEN_READWRITE)
     value = property(get_value, set_value)
 
     @property
@@ -475,6 +751,129 @@ Wrapper around MAPI properties
     def __repr__(self):
         return unicode(self).encode(sys.stdout.encoding or 'utf8')
 
+class Restriction(object):
+    """
+    Server-side restriction, as returned by :class:`Q` comparisons
+
+    Restrictions can be combined using ``&``, ``|`` and ``~``.
+
+"""
+
+    def __init__(self, mapiobj):
+        self.mapiobj = mapiobj
+
+    def __and__(self, restriction):
+        return Restriction(SAndRestriction(self._flatten(SAndRestriction) + restriction._flatten(SAndRestriction)))
+
+    def __or__(self, restriction):
+        return Restriction(SOrRestriction(self._flatten(SOrRestriction) + restriction._flatten(SOrRestriction)))
+
+    def __invert__(self):
+        return Restriction(SNotRestriction(self.mapiobj))
+
+    def _flatten(self, class_):
+        if isinstance(self.mapiobj, class_):
+            return list(self.mapiobj.lpRes)
+        return [self.mapiobj]
+
+    def __unicode__(self):
+        return u'Restriction(%r)' % self.mapiobj
+
+    def __repr__(self):
+        return unicode(self).encode(sys.stdout.encoding or 'utf8')
+
+def _sort_order(tags): # negative proptag means descending
+    if not isinstance(tags, (tuple, list)):
+        tags = (tags,)
+    return SSortOrderSet([SSort(abs(tag), TABLE_SORT_DESCEND if tag < 0 else TABLE_SORT_ASCEND) for tag in tags], 0, 0)
+
+def _restriction(restriction):
+    if isinstance(restriction, Restriction):
+        return restriction.mapiobj
+    return restriction
+
+Q_PROPTAGS = {
+    'subject': PR_SUBJECT_W,
+    'message_class': PR_MESSAGE_CLASS_W,
+    'received': PR_MESSAGE_DELIVERY_TIME,
+    'last_modified': PR_LAST_MODIFICATION_TIME,
+    'size': PR_MESSAGE_SIZE,
+    'importance': PR_IMPORTANCE,
+    'flags': PR_MESSAGE_FLAGS,
+    'headers': PR_TRANSPORT_MESSAGE_HEADERS_W,
+    'sender_name': PR_SENT_REPRESENTING_NAME_W,
+    'sender_email': PR_SENT_REPRESENTING_EMAIL_ADDRESS_W,
+    'name': PR_DISPLAY_NAME_W,
+    'container_class': PR_CONTAINER_CLASS_W,
+}
+
+class _QType(type):
+    def __getattr__(cls, name):
+        try:
+            return cls(Q_PROPTAGS[name])
+        except KeyError:
+            raise AttributeError(name)
+
+class Q(object):
+    """
+    Restriction builder, to let the server select table rows
+
+    Use as ``Q.<name>`` (see ``Q_PROPTAGS``) or ``Q(proptag)``. Comparisons and methods return :class:`Restriction` instances.
+
+    Example::
+
+        folder.items(where=(Q.received < datetime.datetime(2015, 1, 1)) & Q.message_class.startswith('IPM.Note'))
+
+"""
+
+    __metaclass__ = _QType
+
+    def __init__(self, proptag):
+        self.proptag = proptag
+
+    def _sprop(self, value):
+        if isinstance(value, datetime.datetime):
+            value = MAPI.Time.unixtime(time.mktime(value.timetuple()))
+        elif isinstance(value, str) and PROP_TYPE(self.proptag) == PT_UNICODE:
+            value = unicode(value)
+        return SPropValue(self.proptag, value)
+
+    def _compare(self, relop, value):
+        return Restriction(SPropertyRestriction(relop, self.proptag, self._sprop(value)))
+
+    def __lt__(self, value):
+        return self._compare(RELOP_LT, value)
+
+    def __le__(self, value):
+        return self._compare(RELOP_LE, value)
+
+    def __gt__(self, value):
+        return self._compare(RELOP_GT, value)
+
+    def __ge__(self, value):
+        return self._compare(RELOP_GE, value)
+
+    def __eq__(self, value):
+        return self._compare(RELOP_EQ, value)
+
+    def __ne__(self, value):
+        return self._compare(RELOP_NE, value)
+
+    def startswith(self, value, ignorecase=True):
+        return Restriction(SContentRestriction(FL_PREFIX | (FL_IGNORECASE if ignorecase else 0), self.proptag, self._sprop(value)))
+
+    def contains(self, value, ignorecase=True):
+        return Restriction(SContentRestriction(FL_SUBSTRING | (FL_IGNORECASE if ignorecase else 0), self.proptag, self._sprop(value)))
+
+    def exists(self):
+        return Restriction(SExistRestriction(self.proptag))
+
+    def __unicode__(self):
+        return u'Q(%s)' % REV_TAG.get(self.proptag, hex(self.proptag))
+
+    def __repr__(self):
+        return unicode(self).encode(sys.stdout.encoding or 'utf8')
+
 class Table(object):
     """
     Wrapper around MAPI tables
@@ -491,6 +890,10 @@ class Table(object):
             cols = mapitable.QueryColumns(TBL_ALL_COLUMNS) # some columns are hidden by default XXX result (if at all) depends on table implementation 
             cols = cols or mapitable.QueryColumns(0) # fall-back 
             mapitable.SetColumns(cols, 0)
+        if restriction is not None:
+            mapitable.Restrict(_restriction(restriction), TBL_BATCH)
+        if order is not None:
+            self.sort(order)
 
     @property
     def header(self):
@@ -543,9 +946,7 @@ class Table(object):
         return csvfile.getvalue()
 
     def sort(self, tags):
-        if not isinstance(tags, tuple):
-            tags = (tags,)
-        self.mapitable.SortTable(SSortOrderSet([SSort(abs(tag), TABLE_SORT_DESCEND if tag < 0 else TABLE_SORT_ASCEND) for tag in tags], 0, 0), 0)
+        self.mapitable.SortTable(_sort_order(tags), 0)
 
     def __iter__(self):
         return self.rows()
@@ -641,6 +1042,8 @@ Looks at command-line to see if another server address or other related options
         self.pseudo_url = entryid[entryid.find('pseudo:'):-1] # XXX ECSERVER
         self.name = self.pseudo_url[9:] # XXX get this kind of stuff from pr_ec_statstable_servers..?
         self._archive_sessions = {}
+        self._store_entryids = None # store record key -> entryid
+        self._store_cache = collections.OrderedDict() # store entryid -> Store, least recently used first
 
     def nodes(self): # XXX delay mapi sessions until actually needed
         for row in self.table(PR_EC_STATSTABLE_SERVERS).dict_rows():
@@ -711,10 +1114,12 @@ Looks at command-line to see if another server address or other related options
                 for user in Company(self, name).users(): # XXX remote/system check
                     yield user
         except MAPIErrorNoSupport:
-            for username in AddressBook.GetUserList(self.mapisession, None, MAPI_UNICODE):
-                user = User(username, self)
-                if system or username != u'SYSTEM':
-                    if remote or user._ecuser.Servername in (self.name, ''):
+            for ecuser in self.sa.GetUserList(None, MAPI_UNICODE):
+                if not _is_user(ecuser):
+                    continue
+                user = User(server=self, ecuser=ecuser)
+                if system or ecuser.Username != u'SYSTEM':
+                    if remote or ecuser.Servername in (self.name, ''):
                         yield user
                     # XXX following two lines not necessary with python-mapi from trunk
                     elif not remote and user.local: # XXX check if GetUserList can filter local/remote users
@@ -809,13 +1214,35 @@ Looks at command-line to see if another server address or other related options
             storeid = guid.decode('hex')
         except:
             raise ZarafaException("invalid store id: '%s'" % guid)
-        table = self.ems.GetMailboxTable(None, 0) # XXX merge with Store.__init__
-        table.SetColumns([PR_ENTRYID], 0)
-        table.Restrict(SPropertyRestriction(RELOP_EQ, PR_STORE_RECORD_KEY, SPropValue(PR_STORE_RECORD_KEY, storeid)), TBL_BATCH)
-        for row in table.QueryRows(-1, 0):
-            return self.mapisession.OpenMsgStore(0, row[0].Value, None, MDB_WRITE)
+        fresh = self._store_entryids is None # built by the first lookup, so a miss is final
+        for refresh in ((False,) if fresh else (False, True)):
+            entryid = self._store_entryid(storeid, refresh)
+            if entryid is not None:
+                try:
+                    return self.mapisession.OpenMsgStore(0, entryid, None, MDB_WRITE)
+                except MAPIErrorNotFound: # stale index entry
+                    pass
         raise ZarafaException("no such store: '%s'" % guid)
 
+    def _cached_store(self, entryid):
+        """ Return opened :class:`Store` for entryid, keeping the last STORE_CACHE_SIZE stores open """
+
+        try:
+            store = self._store_cache.pop(entryid)
+        except KeyError:
+            store = Store(self, self.mapisession.OpenMsgStore(0, entryid, None, 0))
+            if len(self._store_cache) >= STORE_CACHE_SIZE:
+                self._store_cache.popitem(last=False)
+        self._store_cache[entryid] = store
+        return store
+
+    def _store_entryid(self, storeid, refresh=False):
+        if self._store_entryids is None or refresh: # one mailbox table pass for all stores
+            table = self.ems.GetMailboxTable(None, 0)
+            table.SetColumns([PR_STORE_RECORD_KEY, PR_ENTRYID], 0)
+            self._store_entryids = dict((row[0].Value, row[1].Value) for row in table.QueryRows(-1, 0) if PROP_TYPE(row[0].ulPropTag) != PT_ERROR)
+        return self._store_entryids.get(storeid)
+
     def groups(self):
         for name in MAPI.Util.AddressBook.GetGroupList(self.mapisession, None, MAPI_UNICODE):
             yield Group(name, self)
@@ -867,13 +1294,26 @@ Looks at command-line to see if another server address or other related options
                     yield Store(self, self._store(guid))
             return
 
+        userids = None
+        if not system: # known non-system users, from bulk user lists
+            userids = set(user._ecuser.UserID for user in self.users(remote=True, parse=False))
         table = self.ems.GetMailboxTable(None, 0)
-        table.SetColumns([PR_DISPLAY_NAME_W, PR_ENTRYID], 0)
+        table.SetColumns(MAILBOX_COLUMNS, 0)
         for row in table.QueryRows(-1, 0):
-            store = Store(self, self.mapisession.OpenMsgStore(0, row[1].Value, None, MDB_WRITE))
-            if system or store.public or (store.user and store.user.name != 'SYSTEM'):
+            columns = dict(zip(MAILBOX_COLUMNS, row))
+            store = Store(self, _columns=columns) # store is only opened on first use
+            if system or self._user_or_public(store, columns, userids):
                 yield store
 
+    def _user_or_public(self, store, columns, userids):
+        storetype, owner = columns[PR_EC_STORETYPE], columns[PR_MAILBOX_OWNER_ENTRYID]
+        if PROP_TYPE(storetype.ulPropTag) != PT_ERROR and storetype.Value == ECSTORE_TYPE_PUBLIC:
+            return True
+        if PROP_TYPE(owner.ulPropTag) != PT_ERROR and owner.Value in userids:
+            return True
+        # XXX SYSTEM, orphaned store (owner deleted) or columns not available: check the slow way
+        return store.public or bool(store.user and store.user.name != 'SYSTEM')
+
     def create_store(self, public=False):
         if public:
             mapistore = self.sa.CreateStore(ECSTORE_TYPE_PUBLIC, EID_EVERYONE)
@@ -894,22 +1334,56 @@ Looks at command-line to see if another server address or other related options
         except MAPIErrorNoSupport:
             return self.companies().next().public_store
 
+    def stats(self, users=None):
+        """ Return (:class:`user <User>`, :class:`StoreStats`) pairs for given users (default all users with a store)
+
+        :param users: users to collect statistics for
+        """
+
+        for user in (users if users is not None else self.users()):
+            store = user.store
+            if store:
+                yield user, store.stats()
+
     @property
     def state(self):
         """ Current server state """
 
         return _state(self.mapistore)
 
-    def sync(self, importer, state, log=None, max_changes=None, window=None):
+    def sync(self, importer, state=None, log=None, max_changes=None, window=None, open_items=True, batch_size=SYNC_BATCH_SIZE, batch_time=SYNC_BATCH_TIME, state_store=None, retry_policy=None):
         """ Perform synchronization against server node
 
         :param importer: importer instance with callbacks to process changes
-        :param state: start from this state (has to be given)
+        :param state: start from this state (has to be given, unless a saved state is found in state_store)
         :log: logger instance to receive important warnings/errors
+        :param open_items: open changed items before passing them to the importer; if *False*, items are built from the exporter properties and only opened on demand
+        :param batch_size: pass at most this many changes at once to importer.update_batch/delete_batch (ICS flags in item.flags)
+        :param batch_time: pass pending changes to importer.update_batch/delete_batch after this many seconds
+        :param state_store: :class:`FileStateStore` or :class:`SQLiteStateStore` to resume from and periodically save state to
+        :param retry_policy: :class:`RetryPolicy` for handling errors; skipped changes end up in its quarantine list
         """
 
+        checkpoint = None
+        if state_store:
+            key = u'server/%s' % self.guid
+            state = state_store.load(key) or state
+            checkpoint = lambda state: state_store.save(key, state)
+        if state is None:
+            raise ZarafaException('no state given to sync from')
         importer.store = None
-        return _sync(self, self.mapistore, importer, state, log or self.log, max_changes, window=window)
+        return _sync(self, self.mapistore, importer, state, log or self.log, max_changes, window=window, open_items=open_items, batch_size=batch_size, batch_time=batch_time, checkpoint=checkpoint, retry_policy=retry_policy)
+
+    def watch(self, log=None, poll_interval=SYNC_POLL_INTERVAL, state_store=None, retry_policy=None):
+        """ Return :class:`Watcher` to sync folders on this server as changes are signalled
+
+        :param log: logger instance to receive important warnings/errors
+        :param poll_interval: seconds between sync passes without notifications
+        :param state_store: :class:`FileStateStore` or :class:`SQLiteStateStore` to persist states in
+        :param retry_policy: :class:`RetryPolicy` for handling errors; skipped changes end up in its quarantine list
+        """
+
+        return Watcher(log or self.log, poll_interval, state_store, retry_policy)
 
     def __unicode__(self):
         return u'Server(%s)' % self.server_socket
@@ -925,12 +1399,8 @@ class Group(object):
 
     def users(self):
         for ecuser in self.server.sa.GetUserListOfGroup(self._ecgroup.GroupID, MAPI_UNICODE):
-            if ecuser.Username == 'SYSTEM':
-                continue
-            try:
-                yield User(ecuser.Username, self.server)
-            except ZarafaException: # XXX everyone, groups are included as users..
-                pass
+            if ecuser.Username != u'SYSTEM' and _is_user(ecuser): # XXX everyone, groups are included as users..
+                yield User(server=self.server, ecuser=ecuser)
 
     @property
     def name(self):
@@ -1066,9 +1536,10 @@ class Company(object):
     def users(self):
         """ Return all :class:`users <User>` within company """
 
-        for username in AddressBook.GetUserList(self.server.mapisession, self._name if self._name != u'Default' else None, MAPI_UNICODE): # XXX serviceadmin?
-            if username != 'SYSTEM':
-                yield User(username, self.server)
+        companyid = self._eccompany.CompanyID if self._name != u'Default' else None
+        for ecuser in self.server.sa.GetUserList(companyid, MAPI_UNICODE):
+            if ecuser.Username != u'SYSTEM' and _is_user(ecuser):
+                yield User(server=self.server, ecuser=ecuser)
 
     def create_user(self, name, password=None):
         self.server.create_user(name, password=password, company=self._name)
@@ -1103,13 +1574,35 @@ class Store(object):
     
     """
 
-    def __init__(self, server, mapiobj=None):
+    def __init__(self, server, mapiobj=None, _columns=None):
         if isinstance(server, str): # XXX fix args
             guid, server = server, Server()
             mapiobj = server._store(guid)
         self.server = server
-        self.mapiobj = mapiobj
-        self._root = self.mapiobj.OpenEntry(None, None, 0)
+        self._mapiobj = mapiobj
+        self._columns = _columns # mailbox table row
+        self.__root = None
+        self._name_ids = None # (namespace, name) -> proptag
+        self._folderindex = None
+        self._special_entryids = None # proptag -> entryid
+        self._special_folders = {} # name -> Folder
+        self._guid = None
+
+    @property
+    def mapiobj(self):
+        if self._mapiobj is None: # delayed open for mailbox table-based stores
+            self._mapiobj = self.server.mapisession.OpenMsgStore(0, self._columns[PR_ENTRYID].Value, None, MDB_WRITE)
+        return self._mapiobj
+
+    @mapiobj.setter
+    def mapiobj(self, mapiobj):
+        self._mapiobj = mapiobj
+
+    @property
+    def _root(self):
+        if self.__root is None:
+            self.__root = self.mapiobj.OpenEntry(None, None, 0)
+        return self.__root
 
     @property
     def entryid(self):
@@ -1119,101 +1612,126 @@ class Store(object):
 
     @property
     def public(self):
-        return self.prop(PR_MDB_PROVIDER).mapiobj.Value == ZARAFA_STORE_PUBLIC_GUID
+        if self._columns:
+            storetype = self._columns.get(PR_EC_STORETYPE)
+            if storetype is not None and PROP_TYPE(storetype.ulPropTag) != PT_ERROR:
+                return storetype.Value == ECSTORE_TYPE_PUBLIC
+        return self._special_entryid(PR_MDB_PROVIDER) == ZARAFA_STORE_PUBLIC_GUID
 
     @property
     def guid(self):
         """ Store GUID """
 
-        return bin2hex(self.prop(PR_STORE_RECORD_KEY).value)
+        if self._guid is None: # never changes, and is needed for every sync change
+            self._guid = bin2hex(self.prop(PR_STORE_RECORD_KEY).value)
+        return self._guid
 
     @property
     def hierarchyid(self):
         return  self.prop(PR_EC_HIERARCHYID).value
 
+    def _special_entryid(self, proptag):
+        if self._special_entryids is None: # fetch all at once
+            sprops = self.mapiobj.GetProps(STORE_SPECIAL_PROPTAGS, 0) + self._root.GetProps(ROOT_SPECIAL_PROPTAGS, 0)
+            self._special_entryids = dict((sprop.ulPropTag, sprop.Value) for sprop in sprops if PROP_TYPE(sprop.ulPropTag) != PT_ERROR)
+        try:
+            return self._special_entryids[proptag]
+        except KeyError:
+            raise MAPIErrorNotFound
+
+    def _special_folder(self, name, entryid_func):
+        if name not in self._special_folders:
+            self._special_folders[name] = Folder(self, entryid_func())
+        return self._special_folders[name]
+
+    def clear_cache(self):
+        """ Forget cached special folders and folder index, for example after changing the folder hierarchy elsewhere """
+
+        self._special_entryids = None
+        self._special_folders = {}
+        self._folderindex = None
+
     @property
     def root(self):
         """ :class:`Folder` designated as store root """
 
-        return Folder(self, HrGetOneProp(self._root, PR_ENTRYID).Value)
+        return self._special_folder('root', lambda: self._special_entryid(PR_ENTRYID))
 
     @property
     def inbox(self):
         """ :class:`Folder` designated as inbox """
 
-        return Folder(self, self.mapiobj.GetReceiveFolder('IPM', 0)[0])
+        return self._special_folder('inbox', lambda: self.mapiobj.GetReceiveFolder('IPM', 0)[0])
 
     @property
     def junk(self):
         """ :class:`Folder` designated as junk """
 
         # PR_ADDITIONAL_REN_ENTRYIDS is a multi-value property, 4th entry is the junk folder
-        return Folder(self, HrGetOneProp(self._root, PR_ADDITIONAL_REN_ENTRYIDS).Value[4])
+        return self._special_folder('junk', lambda: self._special_entryid(PR_ADDITIONAL_REN_ENTRYIDS)[4])
 
     @property
     def calendar(self):
         """ :class:`Folder` designated as calendar """
 
-        return Folder(self, HrGetOneProp(self._root, PR_IPM_APPOINTMENT_ENTRYID).Value)
+        return self._special_folder('calendar', lambda: self._special_entryid(PR_IPM_APPOINTMENT_ENTRYID))
 
     @property
     def outbox(self):
         """ :class:`Folder` designated as outbox """
 
-        return Folder(self, HrGetOneProp(self.mapiobj, PR_IPM_OUTBOX_ENTRYID).Value)
+        return self._special_folder('outbox', lambda: self._special_entryid(PR_IPM_OUTBOX_ENTRYID))
 
     @property
     def contacts(self):
         """ :class:`Folder` designated as contacts """
 
-        return Folder(self, HrGetOneProp(self._root, PR_IPM_CONTACT_ENTRYID).Value)
+        return self._special_folder('contacts', lambda: self._special_entryid(PR_IPM_CONTACT_ENTRYID))
 
     @property
     def drafts(self):
         """ :class:`Folder` designated as drafts """
 
-        return Folder(self, HrGetOneProp(self._root, PR_IPM_DRAFTS_ENTRYID).Value)
+        return self._special_folder('drafts', lambda: self._special_entryid(PR_IPM_DRAFTS_ENTRYID))
 
     @property
     def wastebasket(self):
         """ :class:`Folder` designated as wastebasket """
 
-        return Folder(self, HrGetOneProp(self.mapiobj, PR_IPM_WASTEBASKET_ENTRYID).Value)
+        return self._special_folder('wastebasket', lambda: self._special_entryid(PR_IPM_WASTEBASKET_ENTRYID))
 
     @property
     def journal(self):
         """ :class:`Folder` designated as journal """
 
-        return Folder(self, HrGetOneProp(self._root, PR_IPM_JOURNAL_ENTRYID).Value)
+        return self._special_folder('journal', lambda: self._special_entryid(PR_IPM_JOURNAL_ENTRYID))
 
     @property
     def notes(self):
         """ :class:`Folder` designated as notes """
 
-        return Folder(self, HrGetOneProp(self._root, PR_IPM_NOTE_ENTRYID).Value)
+        return self._special_folder('notes', lambda: self._special_entryid(PR_IPM_NOTE_ENTRYID))
 
     @property
     def sentmail(self):
         """ :class:`Folder` designated as sentmail """
 
-        return Folder(self, HrGetOneProp(self.mapiobj, PR_IPM_SENTMAIL_ENTRYID).Value)
+        return self._special_folder('sentmail', lambda: self._special_entryid(PR_IPM_SENTMAIL_ENTRYID))
 
     @property
     def tasks(self):
         """ :class:`Folder` designated as tasks """
 
-        return Folder(self, HrGetOneProp(self._root, PR_IPM_TASK_ENTRYID).Value)
+        return self._special_folder('tasks', lambda: self._special_entryid(PR_IPM_TASK_ENTRYID))
 
     @property
     def subtree(self):
         """ :class:`Folder` designated as IPM.Subtree """
 
         if self.public:
-            ipmsubtreeid = HrGetOneProp(self.mapiobj, PR_IPM_PUBLIC_FOLDERS_ENTRYID).Value
+            return self._special_folder('subtree', lambda: self._special_entryid(PR_IPM_PUBLIC_FOLDERS_ENTRYID))
         else:
-            ipmsubtreeid = HrGetOneProp(self.mapiobj, PR_IPM_SUBTREE_ENTRYID).Value
-
-        return Folder(self, ipmsubtreeid)
+            return self._special_folder('subtree', lambda: self._special_entryid(PR_IPM_SUBTREE_ENTRYID))
 
     @property
     def suggested_contacts(self):
@@ -1231,7 +1749,7 @@ class Store(object):
 
         return Folder(self, entryid.decode('hex'))
 
-    def folder(self, key, recurse=False, create=False): # XXX sloowowowww
+    def folder(self, key, recurse=False, create=False):
         """ Return :class:`Folder` with given name or entryid; raise exception if not found
 
             :param key: name or entryid
@@ -1254,6 +1772,35 @@ class Store(object):
         except ZarafaException:
             pass
 
+    def _folder_index(self, refresh=False):
+        if self._folderindex is None or refresh:
+            self._folderindex = _FolderIndex(self)
+        return self._folderindex
+
+    def _folder_matches(self, parent, key, recurse):
+        # folders below parent with given path or (if recurse) name, or None if parent is not below the subtree
+        fresh = self._folderindex is None # built by the first lookup, so no need to refresh on a miss
+        for refresh in ((False,) if fresh else (False, True)): # on a miss, the hierarchy may have changed
+            index = self._folder_index(refresh)
+            if parent._entryid == index.subtree:
+                base = u''
+            elif parent._entryid in index.paths:
+                base = index.paths[parent._entryid] + u'/'
+            else:
+                return None
+            if recurse and '/' not in key:
+                entryids = [e for e in index.names.get(key, []) if index.paths[e].startswith(base)]
+            else:
+                entryids = [e for e in [index.entryids.get(base + key)] if e]
+            if entryids:
+                try:
+                    return [Folder(self, entryid) for entryid in entryids]
+                except MAPIErrorNotFound:
+                    pass
+        if not index.complete: # folder may be in the part of the hierarchy we couldn't index
+            return None
+        return []
+
     def folders(self, recurse=True, mail=False, parse=True): # XXX mail flag semantic difference?
         """ Return all :class:`folders <Folder>` in store
 
@@ -1270,7 +1817,11 @@ class Store(object):
                 yield self.folder(path.decode(sys.stdin.encoding)) # XXX can optparse output unicode?
             return
 
-        for folder in self.subtree.folders(recurse=recurse):
+        if recurse:
+            folders = self._folder_index(refresh=True).folders(self) # also makes Folder.path cheap
+        else:
+            folders = self.subtree.folders(recurse=False)
+        for folder in folders:
             if not mail or folder.prop(PR_CONTAINER_CLASS) == 'IPF.Note':
                 yield folder
 
@@ -1289,6 +1840,39 @@ class Store(object):
 
         return self.prop(PR_MESSAGE_SIZE_EXTENDED).value
 
+    def stats(self):
+        """ Return :class:`StoreStats` for store, collected using one hierarchy query """
+
+        return StoreStats(self)
+
+    @property
+    def hierarchy_state(self):
+        """ Current folder hierarchy state """
+
+        return _state(self.subtree.mapiobj, hierarchy=True)
+
+    def sync_hierarchy(self, importer, state=None, log=None, max_changes=None, state_store=None, retry_policy=None):
+        """ Perform synchronization of folder hierarchy (below IPM subtree)
+
+        Changed folders are passed to importer.update(folder), deleted folders to importer.delete(folder, flags)
+        (only folder.sourcekey is available for these).
+
+        :param importer: importer instance with callbacks to process changes
+        :param state: start from this state; if not given sync from scratch
+        :log: logger instance to receive important warnings/errors
+        :param state_store: :class:`FileStateStore` or :class:`SQLiteStateStore` to resume from and periodically save state to
+        :param retry_policy: :class:`RetryPolicy` for handling errors; skipped changes end up in its quarantine list
+        """
+
+        checkpoint = None
+        if state_store:
+            key = u'hierarchy/%s' % self.guid
+            state = state_store.load(key) or state
+            checkpoint = lambda state: state_store.save(key, state)
+        if state is None:
+            state = (8*'\0').encode('hex').upper()
+        return _sync(self.server, self.subtree.mapiobj, importer, state, log, max_changes, checkpoint=checkpoint, retry_policy=retry_policy, hierarchy=True, store=self)
+
     def config_item(self, name):
         item = Item()
         item.mapiobj = libcommon.GetConfigMessage(self.mapiobj, 'Zarafa.Quota')
@@ -1318,8 +1902,8 @@ class Store(object):
         """ Store :class:`owner <User>` """
 
         try:
-            userid = HrGetOneProp(self.mapiobj, PR_MAILBOX_OWNER_ENTRYID).Value # XXX
-            return User(self.server.sa.GetUser(userid, MAPI_UNICODE).Username, self.server)
+            userid = self.prop(PR_MAILBOX_OWNER_ENTRYID).value # XXX
+            return User(server=self.server, ecuser=self.server.sa.GetUser(userid, MAPI_UNICODE))
         except MAPIErrorNotFound:
             pass
 
@@ -1342,7 +1926,24 @@ class Store(object):
         else:
             return (self.user.store is None or self.user.store.guid != self.guid)
 
+    def _name_id(self, namespace, name):
+        """ Return (cached) proptag of type PT_UNSPECIFIED for given named property, or *None* if not found """
+
+        key = (namespace, name)
+        if self._name_ids is None:
+            keys = list(NAMED_PROPS_PREFETCH)
+            if key not in keys:
+                keys.append(key)
+            self._name_ids = _name_ids(self.mapiobj, keys)
+        elif key not in self._name_ids: # XXX negative caching?
+            self._name_ids.update(_name_ids(self.mapiobj, [key]))
+        return self._name_ids.get(key)
+
     def prop(self, proptag):
+        if self._columns:
+            prop = _column_prop(self, proptag)
+            if prop:
+                return prop
         return _prop(self, self.mapiobj, proptag)
 
     def props(self):
@@ -1354,25 +1955,118 @@ class Store(object):
     def __repr__(self):
         return unicode(self).encode(sys.stdout.encoding or 'utf8')
 
+class StoreStats(object):
+    """
+    Store statistics: folder/item counts, sizes per folder and per container class, last logon
+
+    """
+
+    def __init__(self, store):
+        sprops = store.mapiobj.GetProps([PR_STORE_RECORD_KEY, PR_MESSAGE_SIZE_EXTENDED, PR_LAST_LOGON_TIME], 0)
+        sprops = [sprop if PROP_TYPE(sprop.ulPropTag) != PT_ERROR else None for sprop in sprops]
+        self.guid = bin2hex(sprops[0].Value) if sprops[0] else None
+        self.size = sprops[1].Value if sprops[1] else 0
+        self.last_logon = Property(store.mapiobj, sprops[2]).value if sprops[2] else None
+
+        self.folders = self.items = self.unread = 0
+        self.folder_sizes = {} # path -> size
+        self.class_counts = {} # container class -> item count
+        self.class_sizes = {} # container class -> size
+        index = store._folder_index(refresh=True)
+        for entryid, columns, depth in index.rows:
+            def value(proptag, default):
+                sprop = columns[proptag]
+                return sprop.Value if PROP_TYPE(sprop.ulPropTag) != PT_ERROR else default
+            count, size, container_class = value(PR_CONTENT_COUNT, 0), value(PR_MESSAGE_SIZE_EXTENDED, 0), value(PR_CONTAINER_CLASS, None)
+            self.folders += 1
+            self.items += count
+            self.unread += value(PR_CONTENT_UNREAD, 0)
+            if entryid in index.paths:
+                self.folder_sizes[index.paths[entryid]] = size
+            self.class_counts[container_class] = self.class_counts.get(container_class, 0) + count
+            self.class_sizes[container_class] = self.class_sizes.get(container_class, 0) + size
+
+    def __unicode__(self):
+        return u'StoreStats(folders=%d, items=%d, size=%s)' % (self.folders, self.items, _bytes_to_human(self.size))
+
+    def __repr__(self):
+        return unicode(self).encode(sys.stdout.encoding or 'utf8')
+
+class _FolderIndex(object):
+    """ Path, name and entryid lookups for folders below the subtree, built from one hierarchy query """
+
+    def __init__(self, store):
+        self.subtree = store.subtree._entryid
+        self.paths = {} # entryid -> path
+        self.entryids = {} # path -> entryid
+        self.names = {} # name -> [entryid, ..]
+        self.rows = [] # (entryid, columns, depth)
+        self.outside = set() # entryids known not to be below the subtree, see Folder.path
+        parents = {} # entryid -> (parent entryid, name)
+        for folder in store.subtree.folders(recurse=True):
+            self.rows.append((folder._entryid, folder._columns, folder.depth))
+            parents[folder._entryid] = (folder._columns[PR_PARENT_ENTRYID].Value, folder.name)
+        for entryid in parents: # rows may come in any order, e.g. after moving a folder
+            self._resolve(entryid, parents)
+        self.complete = (len(self.paths) == len(parents)) # else callers should fall back to walking the hierarchy
+
+    def _resolve(self, entryid, parents):
+        chain = [] # unresolved entryids, from entryid upwards
+        while entryid != self.subtree and entryid not in self.paths:
+            if entryid not in parents or entryid in chain: # missing parent or cycle
+                return
+            chain.append(entryid)
+            entryid = parents[entryid][0]
+        base = self.paths.get(entryid)
+        for entryid in reversed(chain):
+            name = parents[entryid][1]
+            path = name if base is None else base + u'/' + name
+            self.paths[entryid] = path
+            self.entryids[path] = entryid
+            self.names.setdefault(name, []).append(entryid)
+            base = path
+
+    def folders(self, store):
+        for entryid, columns, depth in self.rows:
+            folder = Folder(store, entryid, _columns=columns)
+            folder.depth = depth
+            yield folder
+
 class Folder(object):
     """
     Item Folder
 
     """
 
-    def __init__(self, store, entryid=None, associated=False, deleted=False, mapiobj=None): # XXX entryid not hex-encoded!?
+    def __init__(self, store, entryid=None, associated=False, deleted=False, mapiobj=None, _columns=None): # XXX entryid not hex-encoded!?
         self.store = store
         self.server = store.server
+        self._mapiobj = None
+        self._columns = _columns # hierarchy table row, see Folder.folders
+        self._batch_props = None # proptag -> SPropValue, see Folder.batch
+        self._batch_save = False
         if mapiobj:
             self.mapiobj = mapiobj
             self._entryid = HrGetOneProp(self.mapiobj, PR_ENTRYID).Value
         else:
             self._entryid = entryid
+            if _columns is None:
+                self.mapiobj # open right away, to check entryid
+        self.content_flag = MAPI_ASSOCIATED if associated else (SHOW_SOFT_DELETES if deleted else 0) 
+
+    @property
+    def mapiobj(self):
+        if self._mapiobj is None:
             try:
-                self.mapiobj = store.mapiobj.OpenEntry(entryid, IID_IMAPIFolder, MAPI_MODIFY)
+                self._mapiobj = self.store.mapiobj.OpenEntry(self._entryid, IID_IMAPIFolder, MAPI_MODIFY)
             except MAPIErrorNoAccess: # XXX XXX
-                self.mapiobj = store.mapiobj.OpenEntry(entryid, IID_IMAPIFolder, 0)
-        self.content_flag = MAPI_ASSOCIATED if associated else (SHOW_SOFT_DELETES if deleted else 0) 
+                self._mapiobj = self.store.mapiobj.OpenEntry(self._entryid, IID_IMAPIFolder, 0)
+        _flush_batch(self, self._mapiobj)
+        return self._mapiobj
+
+    @mapiobj.setter
+    def mapiobj(self, mapiobj):
+        self._mapiobj = mapiobj
 
     @property
     def entryid(self):
@@ -1382,7 +2076,7 @@ class Folder(object):
 
     @property
     def sourcekey(self):
-        return bin2hex(HrGetOneProp(self.mapiobj, PR_SOURCE_KEY).Value)
+        return bin2hex(self.prop(PR_SOURCE_KEY).value)
 
     @property
     def parent(self):
@@ -1421,17 +2115,32 @@ class Folder(object):
 
     @property
     def path(self):
-        names = []
+        """ Path relative to the subtree, using '/' as separator """
+
+        index = self.store._folder_index()
+        if self._entryid == index.subtree:
+            return u''
+        if self._entryid not in index.paths and self._entryid not in index.outside: # new folder?
+            index = self.store._folder_index(refresh=True)
+            if self._entryid not in index.paths:
+                index.outside.add(self._entryid) # don't refresh again for this folder
+        if self._entryid in index.paths:
+            return index.paths[self._entryid]
+
+        names = [] # not below subtree
         parent = self
-        while parent and not parent.entryid == self.store.subtree.entryid:
+        while parent and parent._entryid != index.subtree:
             names.append(parent.name)
-            parent = parent.parent
+            grandparent = parent.parent
+            if grandparent and grandparent._entryid == parent._entryid: # root
+                break
+            parent = grandparent
         return '/'.join(reversed(names))
 
     @name.setter
     def name(self, name):
-        self.mapiobj.SetProps([SPropValue(PR_DISPLAY_NAME_W, unicode(name))])
-        self.mapiobj.SaveChanges(KEEP_OPEN_READWRITE)
+        _set_props(self, [SPropValue(PR_DISPLAY_NAME_W, unicode(name))])
+        self.store._folderindex = None
 
     @property
     def container_class(self):
@@ -1451,8 +2160,7 @@ class Folder(object):
 
     @container_class.setter
     def container_class(self, value):
-        self.mapiobj.SetProps([SPropValue(PR_CONTAINER_CLASS, unicode(value))])
-        self.mapiobj.SaveChanges(KEEP_OPEN_READWRITE)
+        _set_props(self, [SPropValue(PR_CONTAINER_CLASS, unicode(value))])
 
     @property
     def unread(self):
@@ -1469,31 +2177,56 @@ class Folder(object):
         item.mapiobj = _openentry_raw(self.store.mapiobj, entryid.decode('hex'), MAPI_MODIFY | self.content_flag)
         return item
 
-    def items(self):
-        """ Return all :class:`items <Item>` in folder, reverse sorted on received date """
+    def items(self, columns=None, where=None, order=-PR_MESSAGE_DELIVERY_TIME, offset=0, limit=None, batch_size=50):
+        """ Return all :class:`items <Item>` in folder, by default reverse sorted on received date
+
+        :param columns: list of proptags to fetch from the contents table; items are then only opened when another property is accessed
+        :param where: :class:`restriction <Restriction>` (see :class:`Q`) to be evaluated by the server
+        :param order: proptag or tuple of proptags to sort on (negative for descending order), or *None* to leave unsorted
+        :param offset: number of items to skip
+        :param limit: maximum number of items to return
+        :param batch_size: number of table rows to fetch at a time
+        """
 
         try:
             table = self.mapiobj.GetContentsTable(self.content_flag)
         except MAPIErrorNoSupport:
             return
 
-        table.SortTable(SSortOrderSet([SSort(PR_MESSAGE_DELIVERY_TIME, TABLE_SORT_DESCEND)], 0, 0), 0) # XXX configure
-        while True:
-            rows = table.QueryRows(50, 0)
+        if where is not None:
+            table.Restrict(_restriction(where), TBL_BATCH)
+
+        if columns is not None:
+            columns = [PR_ENTRYID] + [c for c in columns if c != PR_ENTRYID]
+            table.SetColumns(columns, 0)
+
+        if order is not None:
+            table.SortTable(_sort_order(order), 0)
+        if offset:
+            table.SeekRow(BOOKMARK_BEGINNING, offset)
+
+        while limit is None or limit > 0:
+            count = batch_size if limit is None else min(batch_size, limit)
+            rows = table.QueryRows(count, 0)
             if len(rows) == 0:
                 break
+            if limit is not None:
+                limit -= len(rows)
             for row in rows:
                 item = Item()
                 item.store = self.store
                 item.server = self.server
-                item.mapiobj = _openentry_raw(self.store.mapiobj, PpropFindProp(row, PR_ENTRYID).Value, MAPI_MODIFY | self.content_flag)
+                if columns is not None:
+                    item._columns = dict(zip(columns, row))
+                    item._entryid = row[0].Value
+                    item._content_flag = self.content_flag
+                else:
+                    item.mapiobj = _openentry_raw(self.store.mapiobj, PpropFindProp(row, PR_ENTRYID).Value, MAPI_MODIFY | self.content_flag)
                 yield item
 
     def create_item(self, eml=None, ics=None, vcf=None, load=None, loads=None, **kwargs): # XXX associated
-        item = Item(self, eml=eml, ics=ics, vcf=vcf, load=load, loads=loads, create=True)
+        item = Item(self, eml=eml, ics=ics, vcf=vcf, load=load, loads=loads, create=True, **kwargs)
         item.server = self.server
-        for key, val in kwargs.items():
-            setattr(item, key, val)
         return item
 
     # XXX: always hard delete or but we should also provide 'softdelete' which moves the item to the wastebasket
@@ -1513,9 +2246,15 @@ class Folder(object):
             self.delete(self.items()) # XXX look at associated flag! probably also quite slow
 
     @property
-    def size(self): # XXX bit slow perhaps? :P
+    def size(self):
         """ Folder size """
 
+        if self.content_flag == 0:
+            try:
+                return self.prop(PR_MESSAGE_SIZE_EXTENDED).value
+            except MAPIErrorNotFound:
+                pass
+
         try:
             table = self.mapiobj.GetContentsTable(self.content_flag)
         except MAPIErrorNoSupport:
@@ -1530,18 +2269,33 @@ class Folder(object):
         return size
 
     @property
-    def count(self, recurse=False): # XXX implement recurse?
-        """ Number of items in folder
-
-        :param recurse: include items in sub-folders
+    def count(self):
+        """ Number of items in folder """
 
-        """
+        proptag = {0: PR_CONTENT_COUNT, MAPI_ASSOCIATED: PR_ASSOCIATED_CONTENT_COUNT}.get(self.content_flag)
+        if proptag:
+            try:
+                return self.prop(proptag).value
+            except MAPIErrorNotFound:
+                pass
 
         try:
-            return self.mapiobj.GetContentsTable(self.content_flag).GetRowCount(0) # XXX PR_CONTENT_COUNT, PR_ASSOCIATED_CONTENT_COUNT, PR_CONTENT_UNREAD?
+            return self.mapiobj.GetContentsTable(self.content_flag).GetRowCount(0)
         except MAPIErrorNoSupport:
             return 0
 
+    @property
+    def total_size(self):
+        """ Size of folder including sub-folders """
+
+        return self.size + sum(folder.size for folder in self.folders(recurse=True))
+
+    @property
+    def total_count(self):
+        """ Number of items in folder including sub-folders """
+
+        return self.count + sum(folder.count for folder in self.folders(recurse=True))
+
     def _get_entryids(self, items):
         if isinstance(items, (Item, Folder)):
             items = [items]
@@ -1557,6 +2311,8 @@ class Folder(object):
             self.mapiobj.DeleteMessages(item_entryids, 0, None, DELETE_HARD_DELETE)
         for entryid in folder_entryids:
             self.mapiobj.DeleteFolder(entryid, 0, None, DEL_FOLDERS|DEL_MESSAGES)
+        if folder_entryids:
+            self.store._folderindex = None
 
     def copy(self, items, folder, _delete=False):
         item_entryids, folder_entryids = self._get_entryids(items)
@@ -1564,12 +2320,14 @@ class Folder(object):
             self.mapiobj.CopyMessages(item_entryids, IID_IMAPIFolder, folder.mapiobj, 0, None, (MESSAGE_MOVE if _delete else 0))
         for entryid in folder_entryids:
             self.mapiobj.CopyFolder(entryid, IID_IMAPIFolder, folder.mapiobj, None, 0, None, (FOLDER_MOVE if _delete else 0))
+        if folder_entryids:
+            self.store._folderindex = folder.store._folderindex = None
 
     def move(self, items, folder):
         self.copy(items, folder, _delete=True)
 
     # XXX: almost equal to Store.folder, refactor?
-    def folder(self, key, recurse=False, create=False): # XXX sloowowowww, see also Store.folder
+    def folder(self, key, recurse=False, create=False): # see also Store.folder
         """ Return :class:`Folder` with given name or entryid; raise exception if not found
 
             :param key: name or entryid
@@ -1577,18 +2335,21 @@ class Folder(object):
 
         if len(key) == 96:
             try:
-                folder = Folder(self, key.decode('hex')) # XXX: What about creat=True, do we want to check if it is a valid entryid and then create the folder?
+                folder = Folder(self.store, key.decode('hex')) # XXX: What about creat=True, do we want to check if it is a valid entryid and then create the folder?
                 return folder
             except (MAPIErrorInvalidEntryid, MAPIErrorNotFound, TypeError):
                 pass
 
-        elif '/' in key: # XXX MAPI folders may contain '/' (and '\') in their names..
-            subfolder = self
-            for name in key.split('/'):
-                subfolder = subfolder.folder(name, create=create, recurse=False)
-            return subfolder
+        matches = self.store._folder_matches(self, key, recurse)
+        if matches is None or (not matches and create and '/' in key): # not below subtree, or path to create
+            if '/' in key: # XXX MAPI folders may contain '/' (and '\') in their names..
+                subfolder = self
+                for name in key.split('/'):
+                    subfolder = subfolder.folder(name, create=create, recurse=False)
+                return subfolder
+            if matches is None:
+                matches = [f for f in self.folders(recurse=recurse) if f.entryid == key or f.name == key]
 
-        matches = [f for f in self.folders(recurse=recurse) if f.entryid == key or f.name == key]
         if len(matches) == 0:
             if create:
                 return self.create_folder(key) # XXX assuming no entryid..
@@ -1610,33 +2371,48 @@ class Folder(object):
     def folders(self, recurse=True, depth=0):
         """ Return all :class:`sub-folders <Folder>` in folder
 
+        Folders are only opened when needed; common properties are read from the hierarchy table.
+
         :param recurse: include all sub-folders
         """
 
         try:
-            table = self.mapiobj.GetHierarchyTable(MAPI_UNICODE)
+            table = self.mapiobj.GetHierarchyTable(MAPI_UNICODE | (CONVENIENT_DEPTH if recurse else 0))
         except MAPIErrorNoSupport: # XXX webapp search folder?
             return
 
-        table.SetColumns([PR_ENTRYID], 0)
-        rows = table.QueryRows(-1, 0)
+        table.SetColumns(HIERARCHY_COLUMNS, 0)
+        rows = table.QueryRows(-1, 0) # depth-first order
         for row in rows:
-            subfolder = self.mapiobj.OpenEntry(row[0].Value, None, MAPI_MODIFY)
-            entryid = subfolder.GetProps([PR_ENTRYID], MAPI_UNICODE)[0].Value
-            folder = Folder(self.store, entryid)
-            folder.depth = depth
+            columns = dict(zip(HIERARCHY_COLUMNS, row))
+            folder = Folder(self.store, columns[PR_ENTRYID].Value, _columns=columns)
+            level = columns[PR_DEPTH].Value if columns[PR_DEPTH].ulPropTag == PR_DEPTH else 1
+            folder.depth = depth + level - 1
             yield folder
-            if recurse:
-                for subfolder in folder.folders(depth=depth+1):
-                    yield subfolder
 
     def create_folder(self, name, **kwargs):
         mapifolder = self.mapiobj.CreateFolder(FOLDER_GENERIC, unicode(name), u'', None, MAPI_UNICODE)
+        self.store._folderindex = None
         folder = Folder(self.store, HrGetOneProp(mapifolder, PR_ENTRYID).Value)
-        for key, val in kwargs.items():
-            setattr(folder, key, val)
+        with folder.batch():
+            for key, val in kwargs.items():
+                setattr(folder, key, val)
         return folder
 
+    def batch(self):
+        """ Return context manager collecting property changes, to be saved in one go on exit
+
+        If the block raises, the changes are discarded (the object is reopened on next use).
+
+        Example::
+
+            with folder.batch():
+                folder.name = 'blah'
+                folder.container_class = 'IPF.Note'
+        """
+
+        return _batch(self)
+
     def rules(self):
         rule_table = self.mapiobj.OpenProperty(PR_RULES_TABLE, IID_IExchangeModifyTable, 0, 0)
         table = Table(self.server, rule_table.GetTable(0), PR_RULES_TABLE)
@@ -1644,6 +2420,10 @@ class Folder(object):
             yield Rule(row[PR_RULE_NAME], row[PR_RULE_STATE]) # XXX fix args
 
     def prop(self, proptag):
+        if self._columns:
+            prop = _column_prop(self, proptag)
+            if prop:
+                return prop
         return _prop(self, self.mapiobj, proptag)
 
     def props(self):
@@ -1663,18 +2443,43 @@ class Folder(object):
 
         return _state(self.mapiobj, self.content_flag == MAPI_ASSOCIATED)
 
-    def sync(self, importer, state=None, log=None, max_changes=None, associated=False, window=None):
+    def sync(self, importer, state=None, log=None, max_changes=None, associated=False, window=None, open_items=True, batch_size=SYNC_BATCH_SIZE, batch_time=SYNC_BATCH_TIME, state_store=None, retry_policy=None):
         """ Perform synchronization against folder
 
         :param importer: importer instance with callbacks to process changes
         :param state: start from this state; if not given sync from scratch
         :log: logger instance to receive important warnings/errors
+        :param open_items: open changed items before passing them to the importer; if *False*, items are built from the exporter properties and only opened on demand
+        :param batch_size: pass at most this many changes at once to importer.update_batch/delete_batch (ICS flags in item.flags)
+        :param batch_time: pass pending changes to importer.update_batch/delete_batch after this many seconds
+        :param state_store: :class:`FileStateStore` or :class:`SQLiteStateStore` to resume from and periodically save state to
+        :param retry_policy: :class:`RetryPolicy` for handling errors; skipped changes end up in its quarantine list
         """
 
+        checkpoint = None
+        if state_store:
+            key = u'folder/%s/%s%s' % (self.store.guid, self.sourcekey, '/associated' if associated else '')
+            state = state_store.load(key) or state
+            checkpoint = lambda state: state_store.save(key, state)
         if state is None:
             state = (8*'\0').encode('hex').upper()
-        importer.store = self.store
-        return _sync(self.store.server, self.mapiobj, importer, state, log, max_changes, associated, window=window)
+        importer.store = self.store # XXX compatibility only, the same importer may be used for several stores at once
+        return _sync(self.store.server, self.mapiobj, importer, state, log, max_changes, associated, window=window, open_items=open_items, batch_size=batch_size, batch_time=batch_time, checkpoint=checkpoint, retry_policy=retry_policy, store=self.store)
+
+    def watch(self, importer, state=None, log=None, poll_interval=SYNC_POLL_INTERVAL, state_store=None, retry_policy=None):
+        """ Sync folder whenever the server signals a change (blocks, see :class:`Watcher`)
+
+        :param importer: importer instance with callbacks to process changes
+        :param state: start from this state; if not given sync from scratch
+        :log: logger instance to receive important warnings/errors
+        :param poll_interval: seconds between sync passes without notifications
+        :param state_store: :class:`FileStateStore` or :class:`SQLiteStateStore` to persist state in
+        :param retry_policy: :class:`RetryPolicy` for handling errors; skipped changes end up in its quarantine list
+        """
+
+        watcher = Watcher(log, poll_interval, state_store, retry_policy)
+        watcher.add(self, importer, state)
+        watcher.run()
 
     def readmbox(self, location):
         for message in mailbox.mbox(location):
@@ -1720,7 +2525,9 @@ class Folder(object):
 class Item(object):
     """ Item """
 
-    def __init__(self, parent=None, eml=None, ics=None, vcf=None, load=None, loads=None, create=False, mapiobj=None):
+    def __init__(self, parent=None, eml=None, ics=None, vcf=None, load=None, loads=None, create=False, mapiobj=None, **kwargs):
+        if kwargs and not create:
+            raise TypeError('property arguments (%s) can only be given with create=True' % ', '.join(sorted(kwargs)))
         # TODO: self.folder fix this!
         self.emlfile = eml
         self._folder = None
@@ -1728,6 +2535,12 @@ class Item(object):
             self._folder = parent
         # XXX
         self._architem = None
+        self._mapiobj = None
+        self._entryid = None
+        self._content_flag = 0
+        self._columns = None # contents table row, see Folder.items(columns=..)
+        self._batch_props = None # proptag -> SPropValue, see Item.batch
+        self._batch_save = False
 
         if mapiobj:
             self.mapiobj = mapiobj
@@ -1784,7 +2597,9 @@ class Item(object):
                     elif container_class == 'IPF.Appointment':
                         self.mapiobj.SetProps([SPropValue(PR_MESSAGE_CLASS, 'IPM.Appointment')]) # XXX set default props
 
-            self.mapiobj.SaveChanges(KEEP_OPEN_READWRITE)
+            with _batch(self, save=True):
+                for key, val in kwargs.items():
+                    setattr(self, key, val)
 
     @property
     def _arch_item(self): # make an explicit connection to archive server so we can handle otherwise silenced errors (MAPI errors in mail bodies for example)
@@ -1810,10 +2625,24 @@ class Item(object):
                 self._architem = self.mapiobj
         return self._architem
 
+    @property
+    def mapiobj(self):
+        if self._mapiobj is None and self._entryid is not None: # delayed open for table-based items
+            self._mapiobj = _openentry_raw(self.store.mapiobj, self._entryid, MAPI_MODIFY | self._content_flag)
+        if self._mapiobj is not None:
+            _flush_batch(self, self._mapiobj)
+        return self._mapiobj
+
+    @mapiobj.setter
+    def mapiobj(self, mapiobj):
+        self._mapiobj = mapiobj
+
     @property
     def entryid(self):
         """ Item entryid """
 
+        if self._entryid is not None:
+            return bin2hex(self._entryid)
         return bin2hex(HrGetOneProp(self.mapiobj, PR_ENTRYID).Value)
 
     @property
@@ -1825,7 +2654,7 @@ class Item(object):
         """ Item sourcekey """
 
         if not hasattr(self, '_sourcekey'): # XXX more general caching solution
-            self._sourcekey = bin2hex(HrGetOneProp(self.mapiobj, PR_SOURCE_KEY).Value)
+            self._sourcekey = bin2hex(self.prop(PR_SOURCE_KEY).value)
         return self._sourcekey
 
     @property
@@ -1839,8 +2668,7 @@ class Item(object):
 
     @subject.setter
     def subject(self, x):
-        self.mapiobj.SetProps([SPropValue(PR_SUBJECT_W, unicode(x))])
-        self.mapiobj.SaveChanges(KEEP_OPEN_READWRITE)
+        _set_props(self, [SPropValue(PR_SUBJECT_W, unicode(x))])
 
     @property
     def body(self):
@@ -1870,13 +2698,11 @@ class Item(object):
         * IPM.Appointment                - appointment
         * IPM.Task                       - task
         '''
-        self.mapiobj.SetProps([SPropValue(PR_MESSAGE_CLASS, unicode(messageclass))])
-        self.mapiobj.SaveChanges(KEEP_OPEN_READWRITE)
+        _set_props(self, [SPropValue(PR_MESSAGE_CLASS, unicode(messageclass))])
 
     @body.setter
     def body(self, x):
-        self.mapiobj.SetProps([SPropValue(PR_BODY_W, unicode(x))])
-        self.mapiobj.SaveChanges(KEEP_OPEN_READWRITE)
+        _set_props(self, [SPropValue(PR_BODY_W, unicode(x))])
 
     @property
     def received(self):
@@ -1949,10 +2775,27 @@ class Item(object):
         PR_IMPORTANCE_HIGH
         '''
 
-        self.mapiobj.SetProps([SPropValue(PR_IMPORTANCE, value)])
-        self.mapiobj.SaveChanges(KEEP_OPEN_READWRITE)
+        _set_props(self, [SPropValue(PR_IMPORTANCE, value)])
+
+    def batch(self):
+        """ Return context manager collecting property changes, to be saved in one go on exit
+
+        If the block raises, the changes are discarded (the object is reopened on next use).
+
+        Example::
+
+            with item.batch():
+                item.subject = 'blah'
+                item.body = 'blah blah'
+        """
+
+        return _batch(self)
 
     def prop(self, proptag):
+        if self._columns:
+            prop = _column_prop(self, proptag)
+            if prop:
+                return prop
         return _prop(self, self.mapiobj, proptag)
 
     def props(self, namespace=None):
@@ -1977,16 +2820,34 @@ class Item(object):
                     yield Attachment(att)
 
     def create_attachment(self, name, data):
+        """ Create and return a new :class:`Attachment`
+
+        :param name: filename
+        :param data: binary data, file-like object or iterable of binary blocks
+        """
+
         (id_, attach) = self.mapiobj.CreateAttach(None, 0)
         name = unicode(name)
         props = [SPropValue(PR_ATTACH_LONG_FILENAME_W, name), SPropValue(PR_ATTACH_METHOD, ATTACH_BY_VALUE)]
         attach.SetProps(props)
         stream = attach.OpenProperty(PR_ATTACH_DATA_BIN, IID_IStream, STGM_WRITE|STGM_TRANSACTED, MAPI_MODIFY | MAPI_CREATE)
-        stream.Write(data)
+        if hasattr(data, 'read'):
+            while True:
+                block = data.read(STREAM_BLOCK_SIZE)
+                if not block:
+                    break
+                stream.Write(block)
+        elif isinstance(data, basestring):
+            stream.Write(data)
+        elif isinstance(data, (bytearray, buffer)):
+            stream.Write(str(data))
+        else: # iterable of blocks
+            for block in data:
+                stream.Write(block if isinstance(block, basestring) else str(block))
         stream.Commit(0)
         attach.SaveChanges(KEEP_OPEN_READWRITE)
         self.mapiobj.SaveChanges(KEEP_OPEN_READWRITE) # XXX needed?
-        # XXX return attachment..
+        return Attachment(attach)
 
     def header(self, name):
         """ Return transport message header with given name """
@@ -2069,11 +2930,11 @@ class Item(object):
         return self.recipients() # XXX filter
 
     @property 
-    def start(self): # XXX optimize, guid
+    def start(self):
         return self.prop('common:34070').value
 
     @property 
-    def end(self): # XXX optimize, guid
+    def end(self):
         return self.prop('common:34071').value
 
     @property
@@ -2160,7 +3021,7 @@ class Item(object):
             if (bestbody != PR_NULL and prop.proptag in (PR_BODY_W, PR_HTML, PR_RTF_COMPRESSED) and prop.proptag != bestbody):
                 continue
             if prop.id_ >= 0x8000: # named prop: prop.id_ system dependant..
-                data = [prop.proptag, prop.mapiobj.Value, self.mapiobj.GetNamesFromIDs([prop.proptag], None, 0)[0]]
+                data = [prop.proptag, prop.mapiobj.Value, prop._get_nameid()]
             else:
                 data = [prop.proptag, prop.mapiobj.Value, None]
             props.append(data)
@@ -2286,6 +3147,15 @@ class Body:
         except MAPIErrorNotFound:
             return ''
 
+    def stream(self, type_='text'):
+        """ Return :class:`Stream` for given representation: 'text', 'html' or 'rtf'
+
+        :param type_: body representation
+        """
+
+        proptag = {'text': PR_BODY_W, 'html': PR_HTML, 'rtf': PR_RTF_COMPRESSED}[type_]
+        return Stream(self.mapiitem._arch_item, proptag)
+
     @property
     def type_(self):
         """ original body type: 'text', 'html', 'rtf' or None if it cannot be determined """
@@ -2667,6 +3537,20 @@ class Attachment(object):
             self._data = _stream(self.att, PR_ATTACH_DATA_BIN)
         return self._data
 
+    def stream(self):
+        """ Return :class:`Stream` for reading the binary data block by block """
+
+        return Stream(self.att, PR_ATTACH_DATA_BIN)
+
+    def save(self, f):
+        """ Write binary data to file-like object, block by block
+
+        :param f: file-like object
+        """
+
+        for data in self.stream():
+            f.write(data)
+
     # file-like behaviour
     def read(self):
         return self.data
@@ -2684,14 +3568,24 @@ class Attachment(object):
 class User(object):
     """ User class """
 
-    def __init__(self, name, server=None):
+    def __init__(self, name=None, server=None, ecuser=None):
+        """
+        :param name: account name
+        :param server: :class:`Server` (default a new connection)
+        :param ecuser: ECUSER record as returned by a user list, to avoid resolving the user again
+        """
+
         server = server or Server()
-        self._name = name = unicode(name)
         self.server = server
-        try:
-            self._ecuser = self.server.sa.GetUser(self.server.sa.ResolveUserName(self._name, MAPI_UNICODE), MAPI_UNICODE)
-        except (MAPIErrorNotFound, MAPIErrorInvalidParameter): # multi-tenant, but no '@' in username..
-            raise ZarafaNotFoundException("no such user: '%s'" % name)
+        if ecuser:
+            self._name = unicode(ecuser.Username)
+            self._ecuser = ecuser
+        else:
+            self._name = name = unicode(name)
+            try:
+                self._ecuser = self.server.sa.GetUser(self.server.sa.ResolveUserName(self._name, MAPI_UNICODE), MAPI_UNICODE)
+            except (MAPIErrorNotFound, MAPIErrorInvalidParameter): # multi-tenant, but no '@' in username..
+                raise ZarafaNotFoundException("no such user: '%s'" % name)
         self._mapiobj = None
 
     @property
@@ -2967,39 +3861,76 @@ class Rule:
 
 
 class TrackingContentsImporter(ECImportContentsChanges):
-    def __init__(self, server, importer, log):
+    def __init__(self, server, importer, log, open_items=True, quarantine=None, store=None):
         ECImportContentsChanges.__init__(self, [IID_IExchangeImportContentsChanges, IID_IECImportContentsChanges])
         self.server = server
         self.importer = importer
+        self.store = store # None for server-wide sync
         self.log = log
+        self.open_items = open_items
+        self.quarantine = quarantine if quarantine is not None else [] # sourcekeys of skipped changes
         self.skip = False
+        self.pending = [] # (kind, item, flags) for importers with update_batch/delete_batch
+
+    def _deliver(self, kind, item, flags):
+        if hasattr(self.importer, kind+'_batch'):
+            self.pending.append((kind, item, flags))
+        elif hasattr(self.importer, kind):
+            self.flush() # keep order with batched changes of the other kind
+            getattr(self.importer, kind)(item, flags)
+
+    def flush(self):
+        """ Pass pending changes to importer, one batch per run of updates or deletes; ICS flags are in item.flags """
+
+        pending, self.pending = self.pending, []
+        try:
+            for kind, changes in itertools.groupby(pending, lambda change: change[0]):
+                items = []
+                for (_, item, flags) in changes:
+                    item.flags = flags # e.g. SYNC_NEW_MESSAGE, SYNC_SOFT_DELETE
+                    items.append(item)
+                getattr(self.importer, kind+'_batch')(items)
+        except:
+            self.pending = pending + self.pending # deliver again later, so state doesn't move past them
+            raise
 
     def ImportMessageChangeAsAStream(self, props, flags):
         self.ImportMessageChange(props, flags)
 
     def ImportMessageChange(self, props, flags):
         if self.skip:
+            sourcekey = PpropFindProp(props, PR_SOURCE_KEY)
+            if sourcekey:
+                self.quarantine.append(bin2hex(sourcekey.Value))
             raise MAPIError(SYNC_E_IGNORE)
         try:
             entryid = PpropFindProp(props, PR_ENTRYID)
-            if self.importer.store:
-                mapistore = self.importer.store.mapiobj
+            if self.store:
+                store = self.store
             else:
                 store_entryid = PpropFindProp(props, PR_STORE_ENTRYID).Value
                 store_entryid = WrapStoreEntryID(0, 'zarafa6client.dll', store_entryid[:-4])+self.server.pseudo_url+'\x00'
-                mapistore = self.server.mapisession.OpenMsgStore(0, store_entryid, None, 0)
+                store = self.server._cached_store(store_entryid)
+            mapistore = store.mapiobj
             item = Item()
             item.server = self.server
-            item.store = Store(self.server, mapistore)
+            item.store = store
             try:
-                item.mapiobj = _openentry_raw(mapistore, entryid.Value, 0)
-                item.folderid = PpropFindProp(props, PR_EC_PARENT_HIERARCHYID).Value
-                props = item.mapiobj.GetProps([PR_EC_HIERARCHYID, PR_EC_PARENT_HIERARCHYID, PR_STORE_RECORD_KEY], 0) # XXX properties don't exist?
-                item.docid = props[0].Value
-                # item.folderid = props[1].Value # XXX 
-                item.storeid = bin2hex(props[2].Value)
-                if hasattr(self.importer, 'update'):
-                    self.importer.update(item, flags)
+                if self.open_items:
+                    item.mapiobj = _openentry_raw(mapistore, entryid.Value, 0)
+                    item.folderid = PpropFindProp(props, PR_EC_PARENT_HIERARCHYID).Value
+                    props = item.mapiobj.GetProps([PR_EC_HIERARCHYID, PR_EC_PARENT_HIERARCHYID, PR_STORE_RECORD_KEY], 0) # XXX properties don't exist?
+                    item.docid = props[0].Value
+                    # item.folderid = props[1].Value # XXX 
+                    item.storeid = bin2hex(props[2].Value)
+                else: # change record from exporter props, item is opened on first use
+                    item._entryid = entryid.Value
+                    item._columns = dict((prop.ulPropTag, prop) for prop in props)
+                    item.folderid = PpropFindProp(props, PR_EC_PARENT_HIERARCHYID).Value
+                    docid = PpropFindProp(props, PR_EC_HIERARCHYID)
+                    item.docid = docid.Value if docid else None
+                    item.storeid = store.guid
+                self._deliver('update', item, flags)
             except (MAPIErrorNotFound, MAPIErrorNoAccess): # XXX, mail already deleted, can we do this in a cleaner way?
                 if self.log:
                     self.log.debug('received change for entryid %s, but it could not be opened' % bin2hex(entryid.Value))
@@ -3013,14 +3944,14 @@ class TrackingContentsImporter(ECImportContentsChanges):
 
     def ImportMessageDeletion(self, flags, entries):
         if self.skip:
+            self.quarantine.extend(bin2hex(entry) for entry in entries)
             return
         try:
             for entry in entries:
                 item = Item()
                 item.server = self.server
                 item._sourcekey = bin2hex(entry)
-                if hasattr(self.importer, 'delete'):
-                    self.importer.delete(item, flags)
+                self._deliver('delete', item, flags)
         except Exception, e:
             if self.log:
                 self.log.error('could not process delete for entries: %s' % [bin2hex(entry) for entry in entries])
@@ -3034,6 +3965,448 @@ class TrackingContentsImporter(ECImportContentsChanges):
     def UpdateState(self, stream):
         pass
 
+class TrackingHierarchyImporter(ECImportHierarchyChanges):
+    def __init__(self, server, importer, log, quarantine=None, store=None):
+        ECImportHierarchyChanges.__init__(self, [IID_IExchangeImportHierarchyChanges])
+        self.server = server
+        self.importer = importer
+        self.store = store
+        self.log = log
+        self.quarantine = quarantine if quarantine is not None else [] # sourcekeys of skipped changes
+        self.skip = False
+        self.pending = [] # no batching for folder changes
+
+    def flush(self):
+        pass
+
+    def Config(self, stream, flags):
+        pass
+
+    def ImportFolderChange(self, props):
+        sourcekey = PpropFindProp(props, PR_SOURCE_KEY)
+        if self.skip:
+            if sourcekey:
+                self.quarantine.append(bin2hex(sourcekey.Value))
+            return
+        try:
+            self.store._folderindex = None # XXX update index in place?
+            entryid = PpropFindProp(props, PR_ENTRYID)
+            if entryid:
+                entryid = entryid.Value
+            else:
+                entryid = self.store.mapiobj.EntryIDFromSourceKey(sourcekey.Value, None)
+            folder = Folder(self.store, entryid, _columns=dict((prop.ulPropTag, prop) for prop in props)) # opened on first use
+            if hasattr(self.importer, 'update'):
+                self.importer.update(folder)
+        except Exception, e:
+            if self.log:
+                self.log.error('could not process folder change (%r):' % props)
+                self.log.error(traceback.format_exc(e))
+            else:
+                traceback.print_exc(e)
+
+    def ImportFolderDeletion(self, flags, sourcekeys):
+        if self.skip:
+            self.quarantine.extend(bin2hex(sourcekey) for sourcekey in sourcekeys)
+            return
+        try:
+            self.store._folderindex = None
+            for sourcekey in sourcekeys:
+                folder = Folder(self.store, _columns={PR_SOURCE_KEY: SPropValue(PR_SOURCE_KEY, sourcekey)})
+                if hasattr(self.importer, 'delete'):
+                    self.importer.delete(folder, flags)
+        except Exception, e:
+            if self.log:
+                self.log.error('could not process folder delete for sourcekeys: %s' % [bin2hex(sourcekey) for sourcekey in sourcekeys])
+                self.log.error(traceback.format_exc(e))
+            else:
+                traceback.print_exc(e)
+
+    def UpdateState(self, stream):
+        pass
+
+class RetryPolicy(object):
+    """
+    How sync handles MAPI errors: timeouts and network errors are retried with exponential backoff
+    (and eventually raised), other errors are retried a few times after which the change is skipped.
+    Sourcekeys of skipped changes are collected in *quarantine*, a deque holding the last
+    *max_quarantine* of them; long-running consumers should drain it (using popleft) after
+    each sync pass, as older entries are silently dropped when it is full.
+
+    """
+
+    def __init__(self, max_retries=8, max_change_retries=2, base_delay=0.5, max_delay=30.0, jitter=0.5, max_quarantine=SYNC_MAX_QUARANTINE):
+        """
+        :param max_retries: retries for timeout/network errors before giving up
+        :param max_change_retries: retries for other errors before skipping the change
+        :param base_delay: delay in seconds before the first retry, doubled for every next retry
+        :param max_delay: maximum delay in seconds
+        :param jitter: randomly shorten delays by up to this fraction, so consumers don't retry in lockstep
+        :param max_quarantine: number of skipped sourcekeys to keep
+        """
+
+        self.max_retries = max_retries
+        self.max_change_retries = max_change_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.quarantine = collections.deque(maxlen=max_quarantine)
+
+    def transient(self, error):
+        """ Is error a timeout/network error, instead of a problem with the current change """
+
+        return error.hr in (MAPI_E_NETWORK_ERROR, MAPI_E_TIMEOUT, MAPI_E_END_OF_SESSION)
+
+    def delay(self, retry):
+        """ Delay in seconds before given retry (counting from 0) """
+
+        delay = min(self.max_delay, self.base_delay * 2**retry)
+        return delay * (1 - self.jitter * random.random())
+
+    def __unicode__(self):
+        return u'RetryPolicy(max_retries=%d, max_change_retries=%d)' % (self.max_retries, self.max_change_retries)
+
+    def __repr__(self):
+        return unicode(self).encode(sys.stdout.encoding or 'utf8')
+
+class FileStateStore(object):
+    """
+    Sync states stored as files in a directory, see :func:`Folder.sync`
+
+    """
+
+    def __init__(self, path):
+        """
+        :param path: directory to store states in (created if missing)
+        """
+
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _filename(self, key):
+        return os.path.join(self.path, key.replace('/', '_'))
+
+    def load(self, key):
+        """ Return saved state for key or *None* """
+
+        try:
+            with open(self._filename(key)) as f:
+                return f.read().strip() or None
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def save(self, key, state):
+        """ Save state for key, replacing the previous state atomically """
+
+        filename = self._filename(key)
+        with open(filename+'.tmp', 'w') as f:
+            f.write(state)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(filename+'.tmp', filename)
+
+    def __unicode__(self):
+        return u"FileStateStore('%s')" % self.path
+
+    def __repr__(self):
+        return unicode(self).encode(sys.stdout.encoding or 'utf8')
+
+class SQLiteStateStore(object):
+    """
+    Sync states stored in an SQLite database, see :func:`Folder.sync`
+
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: database file (created if missing)
+        """
+
+        import sqlite3
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, state TEXT NOT NULL)')
+
+    def load(self, key):
+        """ Return saved state for key or *None* """
+
+        with self._lock:
+            for (state,) in self._db.execute('SELECT state FROM sync_state WHERE key = ?', (key,)):
+                return str(state)
+
+    def save(self, key, state):
+        """ Save state for key """
+
+        with self._lock:
+            with self._db:
+                self._db.execute('INSERT OR REPLACE INTO sync_state (key, state) VALUES (?, ?)', (key, state))
+
+    def __unicode__(self):
+        return u"SQLiteStateStore('%s')" % self.filename
+
+    def __repr__(self):
+        return unicode(self).encode(sys.stdout.encoding or 'utf8')
+
+class _SyncRegistration(object):
+    def __init__(self, folder, importer, state):
+        self.folder = folder
+        self.importer = importer
+        self.state = state
+        self.interval = SYNC_HOT_INTERVAL
+        self.due = 0 # time of next turn
+        self.last_change = 0 # time of last turn with changes
+
+class SyncScheduler(object):
+    """
+    Keep many folders in sync using a pool of threads
+
+    Every turn syncs at most *max_changes* changes per folder, so busy folders cannot starve others.
+    Folders with recent changes go first and get another turn right away, while the interval
+    for idle folders doubles up to SYNC_IDLE_INTERVAL seconds.
+
+    """
+
+    def __init__(self, workers=4, max_changes=SYNC_TURN_CHANGES, state_store=None, log=None, retry_policy=None):
+        """
+        :param workers: number of folders to sync concurrently
+        :param max_changes: maximum number of changes per folder per turn
+        :param state_store: :class:`FileStateStore` or :class:`SQLiteStateStore` to persist states in
+        :param log: logger instance to receive important warnings/errors
+        :param retry_policy: :class:`RetryPolicy` for handling errors; skipped changes end up in its quarantine list
+        """
+
+        self.workers = workers
+        self.max_changes = max_changes
+        self.state_store = state_store
+        self.log = log
+        self.retry_policy = retry_policy or RetryPolicy()
+        self._registrations = collections.OrderedDict() # (store guid, folder sourcekey) -> _SyncRegistration
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._pool = None
+
+    def add(self, folder, importer, state=None):
+        """ Register folder to be synced
+
+        :param folder: :class:`Folder` to sync
+        :param importer: importer instance with callbacks to process changes, see :func:`Folder.sync`
+        :param state: start from this state; if not given use saved state or sync from scratch
+        """
+
+        with self._lock:
+            self._registrations[folder.store.guid, folder.sourcekey] = _SyncRegistration(folder, importer, state)
+
+    def remove(self, folder):
+        """ Unregister folder """
+
+        with self._lock:
+            self._registrations.pop((folder.store.guid, folder.sourcekey), None)
+
+    def states(self):
+        """ Return (:class:`Folder`, state) pairs for registered folders """
+
+        with self._lock:
+            return [(reg.folder, reg.state) for reg in self._registrations.values()]
+
+    def run_once(self):
+        """ Give all folders that are due one turn, most recently changed folders first
+
+        :return: number of folders with changes
+        """
+
+        now = time.time()
+        with self._lock:
+            due = [reg for reg in self._registrations.values() if reg.due <= now]
+        if not due:
+            return 0
+        due.sort(key=lambda reg: -reg.last_change)
+        if self._pool is None:
+            self._pool = ThreadPool(self.workers)
+        return sum(self._pool.map(self._turn, due, chunksize=1))
+
+    def run(self):
+        """ Keep running turns until :func:`stop` is called """
+
+        self._stop.clear()
+        try:
+            while not self._stop.is_set():
+                self.run_once()
+                with self._lock:
+                    next_due = min([reg.due for reg in self._registrations.values()] or [time.time() + SYNC_HOT_INTERVAL])
+                self._stop.wait(max(0, min(next_due - time.time(), SYNC_HOT_INTERVAL)))
+        finally:
+            self.close()
+
+    def stop(self):
+        """ Make :func:`run` return after the current turn """
+
+        self._stop.set()
+
+    def close(self):
+        """ Shut down worker threads """
+
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _turn(self, reg):
+        changed = False
+        try:
+            state = reg.folder.sync(reg.importer, reg.state, log=self.log, max_changes=self.max_changes, state_store=self.state_store, retry_policy=self.retry_policy)
+            changed = (state != reg.state)
+            reg.state = state
+        except Exception, e:
+            if self.log:
+                self.log.error('could not sync folder %s: %s' % (reg.folder.sourcekey, traceback.format_exc(e)))
+            else:
+                traceback.print_exc(e)
+        now = time.time()
+        if changed: # possibly more changes pending (max_changes), so go again next turn
+            reg.last_change = now
+            reg.interval = SYNC_HOT_INTERVAL
+            reg.due = now
+        else:
+            reg.due = now + reg.interval
+            reg.interval = min(reg.interval * 2, SYNC_IDLE_INTERVAL)
+        return int(changed)
+
+    def __unicode__(self):
+        return u'SyncScheduler(%d folders)' % len(self._registrations)
+
+    def __repr__(self):
+        return unicode(self).encode(sys.stdout.encoding or 'utf8')
+
+class _AdviseSink(MAPIAdviseSink):
+    def __init__(self, callback):
+        MAPIAdviseSink.__init__(self, [IID_IMAPIAdviseSink])
+        self.callback = callback
+
+    def OnNotify(self, notifications):
+        self.callback()
+        return 0
+
+class _WatchRegistration(object):
+    def __init__(self, folder, importer, state):
+        self.folder = folder
+        self.importer = importer
+        self.state = state
+        self.sink = self.connection = None
+        self.due = 0 # time of next sync pass without notification
+
+class Watcher(object):
+    """
+    Sync folders when the server signals a change, see :func:`Server.watch`
+
+    Folders are watched using change notifications, so idle folders cost nothing. Every folder
+    is also synced each *poll_interval* seconds, in case notifications are unavailable or missed.
+
+    """
+
+    def __init__(self, log=None, poll_interval=SYNC_POLL_INTERVAL, state_store=None, retry_policy=None):
+        """
+        :param log: logger instance to receive important warnings/errors
+        :param poll_interval: seconds between sync passes without notifications
+        :param state_store: :class:`FileStateStore` or :class:`SQLiteStateStore` to persist states in
+        :param retry_policy: :class:`RetryPolicy` for handling errors; skipped changes end up in its quarantine list
+        """
+
+        self.log = log
+        self.poll_interval = poll_interval
+        self.state_store = state_store
+        self.retry_policy = retry_policy or RetryPolicy()
+        self._registrations = {} # (store guid, folder sourcekey) -> _WatchRegistration
+        self._changed = set() # keys of folders with pending notifications
+        self._cond = threading.Condition()
+        self._stopped = False
+
+    def add(self, folder, importer, state=None):
+        """ Start watching folder
+
+        :param folder: :class:`Folder` to watch
+        :param importer: importer instance with callbacks to process changes, see :func:`Folder.sync`
+        :param state: start from this state; if not given use saved state or sync from scratch
+        """
+
+        key = (folder.store.guid, folder.sourcekey)
+        reg = _WatchRegistration(folder, importer, state)
+        reg.sink = _AdviseSink(lambda: self._notify(key))
+        try:
+            reg.connection = folder.store.mapiobj.Advise(folder._entryid, WATCH_EVENTS, reg.sink)
+        except MAPIError:
+            reg.sink = None
+            if self.log:
+                self.log.warn('no notifications for folder %s, polling every %d seconds' % (folder.sourcekey, self.poll_interval))
+        with self._cond:
+            self._registrations[key] = reg
+            self._changed.add(key) # initial pass
+            self._cond.notify()
+
+    def remove(self, folder):
+        """ Stop watching folder """
+
+        with self._cond:
+            reg = self._registrations.pop((folder.store.guid, folder.sourcekey), None)
+        if reg and reg.connection is not None:
+            folder.store.mapiobj.Unadvise(reg.connection)
+
+    def states(self):
+        """ Return (:class:`Folder`, state) pairs for watched folders """
+
+        with self._cond:
+            return [(reg.folder, reg.state) for reg in self._registrations.values()]
+
+    def _notify(self, key):
+        with self._cond:
+            self._changed.add(key)
+            self._cond.notify()
+
+    def run(self):
+        """ Sync watched folders as changes are signalled, until :func:`stop` is called """
+
+        with self._cond:
+            self._stopped = False
+        while True:
+            with self._cond:
+                next_poll = min([reg.due for reg in self._registrations.values()] or [time.time() + self.poll_interval])
+                if not self._changed and not self._stopped and next_poll > time.time():
+                    self._cond.wait(next_poll - time.time())
+                if self._stopped:
+                    break
+                now = time.time()
+                keys = self._changed | set(key for key, reg in self._registrations.items() if reg.due <= now)
+                self._changed = set()
+                regs = [self._registrations[key] for key in keys if key in self._registrations]
+            for reg in regs:
+                self._sync(reg)
+
+    def stop(self):
+        """ Make :func:`run` return after the current sync pass """
+
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def _sync(self, reg):
+        try:
+            reg.state = reg.folder.sync(reg.importer, reg.state, log=self.log, state_store=self.state_store, retry_policy=self.retry_policy)
+        except Exception, e:
+            if self.log:
+                self.log.error('could not sync folder %s: %s' % (reg.folder.sourcekey, traceback.format_exc(e)))
+            else:
+                traceback.print_exc(e)
+        reg.due = time.time() + self.poll_interval
+
+    def __unicode__(self):
+        return u'Watcher(%d folders)' % len(self._registrations)
+
+    def __repr__(self):
+        return unicode(self).encode(sys.stdout.encoding or 'utf8')
+
 def daemon_helper(func, service, log):
     try:
         if not service or isinstance(service, Service):
@@ -3262,6 +4635,11 @@ Example usage::
     try: yield
     except Exception, e: log.error(traceback.format_exc(e))
 
+def _is_user(ecuser):
+    """ Check whether ECUSER record from a user list is an actual (non-contact) user """
+
+    return (ecuser.Class >> 16) == OBJECTTYPE_MAILUSER and ecuser.Class != NONACTIVE_CONTACT
+
 def _bytes_to_human(b):
     suffixes = ['b', 'kb', 'mb', 'gb', 'tb', 'pb']
     if b == 0: return '0 b'
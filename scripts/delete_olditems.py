@@ -27,16 +27,13 @@ def main():
         print 'Running for user:', user.name
         for folder in user.store.folders(parse=True):
             print 'Folder:', folder.name
-            for item in folder.items():
-                if not item.received:
-                    continue
-                if item.received < datetime.today() - timedelta(days=int(args[0])):
-                    if options.verbose:
-                        print 'Item:', item.subject, 'Received:', datetime.today() - item.received
-                    else:
-                        print 'Item:', item.subject
-                    if options.modify:
-                        folder.delete([item])
+            for item in folder.items(where=zarafa.Q.received < datetime.today() - timedelta(days=val)):
+                if options.verbose:
+                    print 'Item:', item.subject, 'Received:', datetime.today() - item.received
+                else:
+                    print 'Item:', item.subject
+                if options.modify:
+                    folder.delete([item])
 
 if __name__ == '__main__':
     main()
@@ -1,5 +1,4 @@
 import zarafa
-import time
 
 class importer:
     def __init__(self, folder, target):
@@ -18,7 +17,4 @@ server = zarafa.Server()
 store = server.user(server.options.auth_user).store # auth_user checks -U/--auth-user command-line option
 inbox, junk = store.inbox, store.junk
 
-state = inbox.state
-while True:
-    state = inbox.sync(importer(inbox, junk), state)
-    time.sleep(1)
+inbox.watch(importer(inbox, junk), inbox.state) # sync whenever the inbox changes
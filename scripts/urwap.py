@@ -1,5 +1,4 @@
 #!/usr/bin/env python
-from itertools import islice
 import sys
 import urwid
 import zarafa
@@ -22,7 +21,7 @@ class MailBox(urwid.ListBox):
         self.refresh()
 
     def refresh(self):
-        self.items = list(islice(self.folder.items(), 0, 100)) # load max 100 items
+        self.items = list(self.folder.items(limit=100)) # load max 100 items
         self.body[:] = [urwid.AttrMap(MailHeader(item), None, 'focus') for item in self.items]
         if self.items:
             self.set_focus(0)
@@ -12,7 +12,8 @@ def b2m(bytes):
 
 def main():
     options, args = opt_args()
-    users = list(zarafa.Server(options).users())
+    server = zarafa.Server(options)
+    users, stats = zip(*server.stats()) or ([], [])
 
     width = 0.35       # the width of the bars
 
@@ -20,13 +21,13 @@ def main():
     ind = range(0, len(users))
     
      
-    data = [b2m(user.store.size) for user in users]
+    data = [b2m(s.size) for s in stats]
     rects1 = ax.bar(ind, data, width, color='r')
 
-    data = [len(list(user.store.folders())) for user in users]
+    data = [s.folders for s in stats]
     rects2 = ax.bar([offset + width for offset in ind], data, width, color='g')
         
-    data =[sum(folder.count for folder in user.store.folders()) for user in users]
+    data = [s.items for s in stats]
     rects3 = ax.bar([offset + width * 2 for offset in ind], data, width, color='b')
 
     ax.legend( (rects1[0], rects2[0], rects3[0]), ('Store size (Mb)', 'Folders', 'Items') )
@@ -16,7 +16,8 @@ def b2m(bytes):
 
 def main():
     options, args = opt_args()
-    users = list(zarafa.Server(options).users())
+    server = zarafa.Server(options)
+    users = list(server.users())
     data = []
 
     fig, ax = plt.subplots()
@@ -26,10 +27,10 @@ def main():
         plt.ylabel('Store size (Mb)')
     elif options.plotfolders:
         # TODO: add mail only flag?
-        data = {user.name: len(list(user.store.folders())) for user in users}
+        data = {user.name: stats.folders for user, stats in server.stats(users)}
         plt.ylabel('Folders')
     elif options.items:
-        data ={user.name: sum(folder.count for folder in user.store.folders()) for user in users}
+        data = {user.name: stats.items for user, stats in server.stats(users)}
         plt.ylabel('Items')
     else:
         return
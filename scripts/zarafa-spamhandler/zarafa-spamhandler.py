@@ -25,15 +25,16 @@ def main():
     for username in users:
         try:
             user = z.user(username)
+            store = user.store
             inboxelements = 0
 
             if autoham:
                 try:
-                    nospamfolder = user.store.folder(hamfolder)
+                    nospamfolder = store.folder(hamfolder)
                 except:
                     if hamfoldercreate:
                         print "%s : create ham folder [%s]" % (user.name, hamfolder)
-                        nospamfolder = user.store.subtree.create_folder(hamfolder)
+                        nospamfolder = store.subtree.create_folder(hamfolder)
                     else:
                         print "%s : has no ham folder [%s]" % (user.name, hamfolder)
 
@@ -53,11 +54,11 @@ def main():
                                 print "failed to run [HAM] [%s]" % ham_output_err
                             if learn:
                                 item.subject = p.sub('', item.subject)
-                                nospamfolder.move(item, user.store.inbox)
+                                nospamfolder.move(item, store.inbox)
                                 print "%s : learned [%s]" % (user.name, learn.rstrip('\n'))
                                 hamlearncounter += 1
 
-            for item in user.store.junk.items():
+            for item in store.junk.items():
                 if autolearn:
                     if (not item.header('x-spam-flag')) or (item.header('x-spam-flag') == 'NO'):
                         print "%s : untagged spam [Subject: %s]" % (user.name, item.subject)
@@ -70,13 +71,13 @@ def main():
                         if learn:
                             print "%s : learned [%s]" % (user.name, learn.rstrip('\n'))
                             delmsg = 'delete after learn'
-                            deletejunk(user, item, delmsg)
+                            deletejunk(user, store, item, delmsg)
                             learncounter += 1
 
                 if autodelete:
                     if item.received.date() < (datetime.date.today() - datetime.timedelta(days=deleteafter)):
                         delmsg = 'autodelete'
-                        deletejunk(user, item, delmsg)
+                        deletejunk(user, store, item, delmsg)
         except Exception as error:
             print "%s : Unable to open store/item : [%s] [%s]" % (username, username, error)
             continue
@@ -84,10 +85,10 @@ def main():
     print "Summary learned %d SPAM items %d HAM items, deleted %d items" % (learncounter, hamlearncounter, delcounter)
 
 
-def deletejunk(user, item, delmsg):
+def deletejunk(user, store, item, delmsg):
     global delcounter
     try:
-        user.store.junk.delete([item])
+        store.junk.delete([item])
         print "%s : %s [Subject: %s]" % (user.name, delmsg, item.subject)
         delcounter += 1
     except Exception as error:
@@ -11,9 +11,10 @@ import zarafa
 ITEM_MAPPING = {}
 
 def proplist(item):
-    biggest = max((len(prop.strid or 'None') for prop in item.props()))
+    itemprops = list(item.props())
+    biggest = max((len(prop.strid or 'None') for prop in itemprops))
     props = []
-    for prop in item.props():
+    for prop in itemprops:
         offset = biggest - len(prop.strid or 'None')
         props.append('%s %s%s\n' % (prop.strid, ' ' * offset,  prop.strval))
     return props
@@ -70,13 +71,7 @@ def main():
             ITEM_MAPPING[item.sourcekey] = item
         print 'Mapping of items and sourcekey complete'
 
-        folder_state = folder.state
-        new_state = folder.sync(Importer(), folder_state) # from last known state
-        while True:
-            new_state = folder.sync(Importer(), folder_state) # from last known state
-            if new_state != folder_state:
-                folder_state = new_state
-            time.sleep(1)
+        folder.watch(Importer(), folder.state) # from last known state, whenever the folder changes
 
 if __name__ == '__main__':
     main()